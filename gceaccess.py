@@ -5,20 +5,62 @@ garmin.com access for exporting data files
 
 """
 
+import http.client
 import http.cookiejar
 import json
 import logging
+import os
+import random
 import re
+import tempfile
+import time
 import urllib.error
 import urllib.parse
 import urllib.request
-from os.path import sep
+from os.path import basename, isfile, sep
 
+import gcecolumns
+import gceindex
+import gcemetrics
+import gcepack
 import gceutils
 
 log = logging.getLogger(__name__)
 
 LIMIT_MAXIMUM = 1000
+# page size of the activity list in --incremental mode
+LIMIT_INCREMENTAL = 20
+# optional gcerate.HostRateLimiter, every request waits for its host's turn
+RATE_LIMITER = None
+# optional gceasync.AsyncEngine; when set, http_req sends everything through its event loop
+ENGINE = None
+# optional gcepool.ConnectionPool; when set, http_req reuses keep-alive connections instead of OPENER
+POOL = None
+# optional gcecache.TTLCache of the app info JSON per deviceApplicationInstallationId
+DEVICE_CACHE = None
+# optional gcegear.GearResolver, resolves the gear of all activities with a few calls
+GEAR_RESOLVER = None
+# optional gcepack.PackStore; when set, the JSON artifacts go into its pack instead of loose files
+PACK = None
+# url -> future of requests started ahead of time with prefetch()
+PREFETCHED = {}
+# seconds to wait for a connection and for each piece of a response, None waits forever
+CONNECT_TIMEOUT = None
+READ_TIMEOUT = None
+# a failed GET is sent again up to RETRIES times, after a random wait of up to
+# BACKOFF_BASE * 2^attempt seconds (at most BACKOFF_MAX); POSTs are never repeated
+RETRIES = 0
+BACKOFF_BASE = 1
+BACKOFF_MAX = 60
+# 500 is not in here: Garmin answers a TCX download of a manual upload with it, every time
+RETRY_CODES = (429, 502, 503, 504)
+# data files are read from the network in pieces of this size
+CHUNK_SIZE = 65536
+# with --storage pack the details of an activity are held in memory up to this size on their
+# way into the pack (beyond, in a temporary file)
+DETAIL_SPOOL_SIZE = 4 * 1024 * 1024
+# counts and times every request by endpoint; gcexport3 times its stages into it as well
+METRICS = gcemetrics.Metrics()
 
 
 def query_garmin_stats():
@@ -41,14 +83,23 @@ def query_garmin_stats():
     return user_stats
 
 
-def download_data(download_url, formattype):
-    # Download the data file from Garmin Connect. If the download fails (e.g., due to timeout),
-    # this script will die, but nothing will have been written to disk about this activity, so
-    # just running it again should pick up where it left off.
+def download_data(download_url, formattype, target):
+    """
+    Download the data file from Garmin Connect straight into target.
+    :param target: the file name to write to, or an open binary file (e.g. a spooled
+                   temporary file for an original ZIP that is unzipped right away)
+    :return: True if the file was written, False if Garmin has no file of this format
+    """
+    # If the download fails (e.g., due to timeout) after all retries, this script will die,
+    # but nothing will have been written to disk about this activity except the partial
+    # file, so just running it again should pick up where it left off.
     log.info("\tDownloading file...")
-    data = ""
+    written = False
     try:
-        data = http_req(download_url)
+        if isinstance(target, str):
+            written = download_to_file(download_url, target)
+        else:
+            written = download_into(download_url, target)
     except urllib.error.HTTPError as errs:
         # Handle expected (though unfortunate) error codes; die on unexpected ones.
         if errs.code == 500 and formattype == "tcx":
@@ -59,16 +110,113 @@ def download_data(download_url, formattype):
             # format if you want actual data in every file, as I believe Garmin provides a GPX
             # file for every activity.
             log.info("\t\tWriting empty file since Garmin did not generate a TCX file for this activity...")
-            data = ""
         elif errs.code == 404 and formattype == "original":
             # For manual activities (i.e., entered in online without a file upload), there is
             # no original file. # Write an empty file to prevent redownloading it.
             log.info("\t\tWriting empty file since there was no original activity data...")
-            data = ""
         else:
             raise Exception("Failed. Got an unexpected HTTP error (" + str(errs.code) + download_url + ").")
-    finally:
-        return data
+    return written
+
+
+def download_to_file(url, filename):
+    """
+    GET a data file into filename + ".part" and rename it to filename once it is complete,
+    so filename never holds half a file. An interrupted download leaves the part file
+    behind, the next run asks for the rest only.
+    :return: True if the file was written, False for 204 (no content)
+    """
+    part_filename = filename + ".part"
+    try:
+        with open(part_filename, "ab") as part_file:
+            written = download_into(url, part_file)
+    except BaseException:
+        # e.g. the expected 404 of an original: a part file without a byte has nothing to resume
+        if os.path.getsize(part_filename) == 0:
+            os.remove(part_filename)
+        raise
+    if written:
+        os.replace(part_filename, filename)
+    else:
+        os.remove(part_filename)
+    return written
+
+
+def download_into(url, target):
+    """
+    GET a data file in pieces of CHUNK_SIZE and append it to the binary file target, so
+    memory use does not grow with the file size. What target holds already is taken as
+    the beginning of the file: the request asks for the rest with a Range header, and so
+    does the retry after a transfer that broke off.
+    :return: True if the file was written, False for 204 (no content)
+    """
+    attempt = 0
+    name = endpoint(url)
+    while True:
+        target.seek(0, os.SEEK_END)
+        offset = target.tell()
+        headers = {"Range": "bytes=" + str(offset) + "-"} if offset else None
+        started = time.monotonic()
+        try:
+            response = http_stream(url, headers)
+        except urllib.error.HTTPError as error:
+            METRICS.request(name, time.monotonic() - started, 0, error.code)
+            if error.code == 416 and offset:
+                # the part file already has the whole file
+                log.debug("partial download of " + url + " is complete")
+                return True
+            if error.code not in RETRY_CODES or attempt >= RETRIES:
+                raise
+            backoff(url, attempt, error)
+            attempt += 1
+            continue
+        except (OSError, http.client.HTTPException) as error:
+            METRICS.request(name, time.monotonic() - started, 0, None)
+            if attempt >= RETRIES:
+                raise
+            backoff(url, attempt, error)
+            attempt += 1
+            continue
+        if response.status == 204:
+            response.close()
+            METRICS.request(name, time.monotonic() - started, 0, 204)
+            # For activities without GPS coordinates, there is no GPX download (204 = no content).
+            log.info("No GPX activity data, nothing written...")
+            return False
+        if response.status not in (200, 206):
+            response.close()
+            METRICS.request(name, time.monotonic() - started, 0, response.status)
+            raise Exception("Bad return code (" + str(response.status) + ") for: " + url)
+        if response.status == 206:
+            log.debug("resuming " + url + " at byte " + str(offset))
+        elif offset:
+            # a 200 to a Range request is the whole file again
+            target.seek(0)
+            target.truncate()
+        received = 0
+        try:
+            chunk = response.read(CHUNK_SIZE)
+            while chunk:
+                target.write(chunk)
+                received += len(chunk)
+                chunk = response.read(CHUNK_SIZE)
+            response.close()
+            expected = response.getheader("Content-Length")
+            if expected and expected.isdigit() and received < int(expected):
+                # http.client hands out a body that was cut off as if it were complete
+                raise http.client.IncompleteRead(b"", int(expected) - received)
+        except (OSError, http.client.HTTPException) as error:
+            response.close()
+            target.flush()
+            # the bytes that arrived are kept, the retry asks for the rest
+            METRICS.request(name, time.monotonic() - started, received, None)
+            if attempt >= RETRIES:
+                raise
+            backoff(url, attempt, error)
+            attempt += 1
+            continue
+        METRICS.request(name, time.monotonic() - started, received, response.status)
+        return True
 
 
 def gclogin(username, password):
@@ -109,351 +257,373 @@ def gclogin(username, password):
     log.debug("Finished authentication")
 
 
+def loadsession(filename):
+    """
+    Load the cookies of an earlier session into COOKIE_JAR.
+    :return: True if there was a session file to load
+    """
+    if not isfile(filename):
+        return False
+    try:
+        # the Garmin session cookies are session cookies, keep them anyway
+        COOKIE_JAR.load(filename, ignore_discard=True)
+    except (OSError, http.cookiejar.LoadError) as error:
+        print("Unable to load the session file " + filename + " Error: " + str(error))
+        return False
+    log.debug("loaded " + str(len(COOKIE_JAR)) + " cookies from " + filename)
+    return True
+
+
+def savesession(filename):
+    """Store the cookies of COOKIE_JAR, readable for the current user only."""
+    # create the file with restricted permissions before any cookie is written to it
+    os.close(os.open(filename, os.O_WRONLY | os.O_CREAT, 0o600))
+    os.chmod(filename, 0o600)
+    COOKIE_JAR.save(filename, ignore_discard=True)
+    log.debug("saved " + str(len(COOKIE_JAR)) + " cookies to " + filename)
+
+
+def sessionvalid():
+    """Check with one request for the profile page whether the cookies still log us in."""
+    try:
+        profile_page = http_req(URL_GC_PROFILE)
+    except Exception as error:
+        log.debug("stored session rejected: " + str(error))
+        return False
+    # without a valid session Garmin redirects to the sign in page, which has no display name
+    pattern = re.compile(r".*\\\"displayName\\\":\\\"([-.\w]+)\\\".*", re.MULTILINE | re.DOTALL)
+    if profile_page and pattern.match(profile_page.decode()):
+        return True
+    log.debug("stored session expired")
+    COOKIE_JAR.clear()
+    return False
+
+
+def backoff(url, attempt, error):
+    """Sleep before retry number attempt + 1, honoring the Retry-After of a 429 or 503."""
+    delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+    retry_after = None
+    if isinstance(error, urllib.error.HTTPError) and error.headers:
+        retry_after = error.headers.get("Retry-After")
+    if retry_after and retry_after.isdigit():
+        delay = max(delay, min(BACKOFF_MAX, int(retry_after)))
+    print("Request for " + url + " failed (" + str(error) + "), retrying in " + "{0:.1f}".format(delay) + "s")
+    time.sleep(delay)
+
+
 def http_req(url, post=None, headers=None):
-    """Helper function that makes the HTTP requests."""
+    """Helper function that makes the HTTP requests; GETs are retried on timeouts, 429 and 502-504."""
+    attempt = 0
+    name = endpoint(url)
+    while True:
+        started = time.monotonic()
+        try:
+            data = http_req_once(url, post, headers)
+            METRICS.request(name, time.monotonic() - started, len(data), 204 if data == "" else 200)
+            return data
+        except urllib.error.HTTPError as error:
+            METRICS.request(name, time.monotonic() - started, 0, error.code)
+            if post is not None or error.code not in RETRY_CODES or attempt >= RETRIES:
+                raise
+            backoff(url, attempt, error)
+        except (OSError, http.client.HTTPException) as error:
+            METRICS.request(name, time.monotonic() - started, 0, None)
+            if post is not None or attempt >= RETRIES:
+                raise
+            backoff(url, attempt, error)
+        attempt += 1
+
+
+def endpoint(url):
+    """
+    The name of the URL_* constant url was built from, e.g. URL_GC_ACTIVITY, for the
+    metrics; the details of an activity are counted apart as URL_GC_ACTIVITY/details.
+    """
+    name = "other"
+    prefix = ""
+    for key, value in globals().items():
+        if key.startswith("URL_") and len(value) > len(prefix) and url.startswith(value):
+            name = key
+            prefix = value
+    if name == "URL_GC_ACTIVITY" and url.endswith("/details"):
+        return name + "/details"
+    return name
+
+
+def http_req_once(url, post=None, headers=None):
+    """Make one HTTP request."""
+    if ENGINE:
+        # the asyncio engine does its own rate limiting; a prefetched request is just collected
+        future = PREFETCHED.pop(url, None) if post is None else None
+        if future is None:
+            future = ENGINE.submit(url, post, headers)
+        return future.result()
     request = urllib.request.Request(url)
     # Tell Garmin we're some supported browser.
-    request.add_header(
-        "User-Agent",
-        "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, \
-        like Gecko) Chrome/54.0.2816.0 Safari/537.36",
-    )
+    request.add_header("User-Agent", USER_AGENT)
     if headers:
         for header_key, header_value in headers.items():
             request.add_header(header_key, header_value)
     if post:
         post = urllib.parse.urlencode(post)
         post = post.encode("utf-8")  # Convert dictionary to POST parameter string.
+    if RATE_LIMITER:
+        RATE_LIMITER.wait(url)
     # print("request.headers: " + str(request.headers) + " COOKIE_JAR: " + str(COOKIE_JAR))
     # print("post: " + str(post) + "request: " + str(request))
-    response = OPENER.open(request, data=post)
-
-    if response.getcode() == 204:
+    try:
+        if POOL:
+            code, data = POOL.open(url, post, headers)
+        else:
+            response = OPENER.open(request, data=post, timeout=READ_TIMEOUT)
+            code = response.getcode()
+            data = response.read() if code == 200 else ""
+    except urllib.error.HTTPError as error:
+        if RATE_LIMITER:
+            RATE_LIMITER.feedback(url, error.code)
+        raise
+    except (OSError, http.client.HTTPException):
+        # timeouts and dropped connections (URLError is an OSError as well)
+        if RATE_LIMITER:
+            RATE_LIMITER.feedback(url, None)
+        raise
+    if RATE_LIMITER:
+        RATE_LIMITER.feedback(url, code)
+
+    if code == 204:
         # For activities without GPS coordinates, there is no GPX download (204 = no content).
         # Write an empty file to prevent redownloading it.
         log.info("Writing empty file since there was no GPX activity data...")
         return ""
-    elif response.getcode() != 200:
-        raise Exception("Bad return code (" + str(response.getcode()) + ") for: " + url)
+    elif code != 200:
+        raise Exception("Bad return code (" + str(code) + ") for: " + url)
     # print(response.getcode())
 
-    return response.read()
+    return data
 
 
-def createjson(directory, stractId, actsum):
-    json_summary = json.loads(actsum)
-    log.debug(json_summary)
-    log.debug("Device detail URL: " + URL_DEVICE_DETAIL
-              + str(json_summary["metadataDTO"]["deviceApplicationInstallationId"]))
-    device_detail = http_req(
-        URL_DEVICE_DETAIL
-        + str(json_summary["metadataDTO"]["deviceApplicationInstallationId"])
-    )
-    if device_detail:
-        gceutils.write_to_file(
-            directory + sep + stractId + "_app_info.json",
-            device_detail.decode(), "a",
-        )
-        json_device = json.loads(device_detail)
-        log.debug(json_device)
-    else:
-        log.debug("Retrieving Device Details failed.")
-        json_device = None
-    log.debug("Activity details URL: " + URL_GC_ACTIVITY + stractId + "/details")
+def http_stream(url, headers=None):
+    """
+    GET url and return the response as soon as its headers are there, for the caller to
+    read() in pieces and close(). 4xx/5xx raise urllib.error.HTTPError.
+    """
+    if ENGINE:
+        return ENGINE.stream(url, headers)
+    request = urllib.request.Request(url)
+    request.add_header("User-Agent", USER_AGENT)
+    if headers:
+        for header_key, header_value in headers.items():
+            request.add_header(header_key, header_value)
+    if RATE_LIMITER:
+        RATE_LIMITER.wait(url)
     try:
-        activity_detail = http_req(
-            URL_GC_ACTIVITY + stractId + "/details"
-        )
-        gceutils.write_to_file(
-            directory + sep + stractId + "_activity_detail.json",
-            activity_detail.decode(), "a",
-        )
-        json_detail = json.loads(activity_detail)
-        log.debug(json_detail)
-    except Exception as error:
-        print("Retrieving Activity Details failed. Reason: " + str(error))
-        json_detail = None
-    log.debug("Gear details URL: " + URL_GEAR_DETAIL + "activityId=" + stractId)
-    gear_detail = http_req(URL_GEAR_DETAIL + "activityId=" + stractId)
+        if POOL:
+            response = POOL.stream(url, None, headers)
+        else:
+            response = OPENER.open(request, timeout=READ_TIMEOUT)
+    except urllib.error.HTTPError as error:
+        if RATE_LIMITER:
+            RATE_LIMITER.feedback(url, error.code)
+        raise
+    except (OSError, http.client.HTTPException):
+        if RATE_LIMITER:
+            RATE_LIMITER.feedback(url, None)
+        raise
+    if RATE_LIMITER:
+        RATE_LIMITER.feedback(url, response.status)
+    return response
+
+
+def setbaseurl(base_url):
+    """
+    Send the requests to base_url instead of the Garmin hosts, e.g. to the stand-in of
+    gcemock.py; the paths stay the same.
+    """
+    base_url = base_url.rstrip("/")
+    for name, value in list(globals().items()):
+        if name.startswith("URL_"):
+            globals()[name] = re.sub(r"^https?://(sso|connect)\.garmin\.com", base_url, value)
+    log.info("sending the requests to " + base_url)
+
+
+def prefetch(url):
+    """
+    Start a GET request on the asyncio engine without waiting for it; the next http_req
+    for the same url collects the response. Without the engine this does nothing.
+    """
+    if ENGINE and url not in PREFETCHED:
+        PREFETCHED[url] = ENGINE.submit(url)
+
+
+def dropprefetch(*urls):
+    """Forget requests started with prefetch() that no http_req will collect, e.g. of an activity given up."""
+    for url in urls:
+        future = PREFETCHED.pop(url, None)
+        if future:
+            future.cancel()
+
+
+def writejson(filename, content):
+    """
+    Persist a JSON artifact, or put it as a record into the pack with --storage pack. The
+    artifact of an activity replaces what an earlier fetch wrote, the pages of the activity
+    list and the user stats are appended.
+    """
+    with METRICS.stage("write_json"):
+        if PACK:
+            PACK.put(basename(filename), content)
+        else:
+            gceutils.write_to_file(filename, content, "a" if basename(filename) in gcepack.APPENDED else "w")
+
+
+def readartifact(filename):
+    """The text of a JSON artifact written by an earlier run, None if it is not there (anymore)."""
+    if PACK:
+        return PACK.get(basename(filename))
     try:
-        gceutils.write_to_file(directory + sep + stractId + "_gear_detail.json",
-                               gear_detail.decode(),
-                               "a", )
-        json_gear = json.loads(gear_detail)
-        log.debug(json_gear)
-    except Exception as error:
-        print("Retrieving Gear Details failed. Error: " + str(error))
-        json_gear = None
+        with open(filename, encoding="utf-8") as json_file:
+            return json_file.read()
+    except OSError:
+        return None
 
-    return json_summary, json_gear, json_device, json_detail
 
+def readjson(filename):
+    """Load a JSON artifact written by an earlier run, None if it is not there (anymore)."""
+    text = readartifact(filename)
+    try:
+        return gceutils.lastjson(text) if text is not None else None
+    except ValueError:
+        return None
 
-def buildcsvrecord(a, json_summary, json_gear, json_device, json_detail):
-    # Write stats to CSV.
-    empty_record = ","
-    csv_record = ""
-    csv_record += (
-        empty_record
-        if "activityName" not in a or not a["activityName"]
-        else '"' + a["activityName"].replace('"', '""') + '",'
-    )
-    # maybe a more elegant way of coding this but need to handle description as null
-    if "description" not in a:
-        csv_record += empty_record
-    elif a["description"] is not None:
-        csv_record += '"' + a["description"].replace('"', '""') + '",'
-    else:
-        csv_record += empty_record
-    # Gear detail returned as an array so pick the first one
-    csv_record += (
-        empty_record
-        if not json_gear or "customMakeModel" not in json_gear[0]
-        else json_gear[0]["customMakeModel"] + ","
-    )
-    csv_record += (
-        empty_record
-        if "startTimeLocal" not in json_summary["summaryDTO"]
-        else '"' + json_summary["summaryDTO"]["startTimeLocal"] + '",'
-    )
-    csv_record += (
-        empty_record
-        if "elapsedDuration" not in json_summary["summaryDTO"]
-        else gceutils.hhmmss_from_seconds(json_summary["summaryDTO"]["elapsedDuration"]) + ","
-    )
-    csv_record += (
-        empty_record
-        if "movingDuration" not in json_summary["summaryDTO"]
-        else gceutils.hhmmss_from_seconds(json_summary["summaryDTO"]["movingDuration"]) + ","
-    )
-    csv_record += (
-        empty_record
-        if "distance" not in json_summary["summaryDTO"]
-        else "{0:.5f}".format(json_summary["summaryDTO"]["distance"] / 1000) + ","
-    )
-    csv_record += (
-        empty_record
-        if "averageSpeed" not in json_summary["summaryDTO"]
-        else gceutils.kmh_from_mps(json_summary["summaryDTO"]["averageSpeed"]) + ","
-    )
-    csv_record += (
-        empty_record
-        if "averageMovingSpeed" not in json_summary["summaryDTO"]
-        else gceutils.kmh_from_mps(json_summary["summaryDTO"]["averageMovingSpeed"]) + ","
-    )
-    csv_record += (
-        empty_record
-        if "maxSpeed" not in json_summary["summaryDTO"]
-        else gceutils.kmh_from_mps(json_summary["summaryDTO"]["maxSpeed"]) + ","
-    )
-    csv_record += (
-        empty_record
-        if "elevationLoss" not in json_summary["summaryDTO"]
-        else str(json_summary["summaryDTO"]["elevationLoss"]) + ","
-    )
-    csv_record += (
-        empty_record
-        if "elevationGain" not in json_summary["summaryDTO"]
-        else str(json_summary["summaryDTO"]["elevationGain"]) + ","
-    )
-    csv_record += (
-        empty_record
-        if "minElevation" not in json_summary["summaryDTO"]
-        else str(json_summary["summaryDTO"]["minElevation"]) + ","
-    )
-    csv_record += (
-        empty_record
-        if "maxElevation" not in json_summary["summaryDTO"]
-        else str(json_summary["summaryDTO"]["maxElevation"]) + ","
-    )
-    csv_record += empty_record if "minHR" not in json_summary["summaryDTO"] else ","
-    csv_record += (
-        empty_record
-        if "maxHR" not in json_summary["summaryDTO"]
-        else str(json_summary["summaryDTO"]["maxHR"]) + ","
-    )
-    csv_record += (
-        empty_record
-        if "averageHR" not in json_summary["summaryDTO"]
-        else str(json_summary["summaryDTO"]["averageHR"]) + ","
-    )
-    csv_record += (
-        empty_record
-        if "calories" not in json_summary["summaryDTO"]
-        else str(json_summary["summaryDTO"]["calories"]) + ","
-    )
-    csv_record += (
-        empty_record
-        if "averageBikeCadence" not in json_summary["summaryDTO"]
-        else str(json_summary["summaryDTO"]["averageBikeCadence"]) + ","
-    )
-    csv_record += (
-        empty_record
-        if "maxBikeCadence" not in json_summary["summaryDTO"]
-        else str(json_summary["summaryDTO"]["maxBikeCadence"]) + ","
-    )
-    csv_record += (
-        empty_record
-        if "totalNumberOfStrokes" not in json_summary["summaryDTO"]
-        else str(json_summary["summaryDTO"]["totalNumberOfStrokes"]) + ","
-    )
-    csv_record += (
-        empty_record
-        if "averageTemperature" not in json_summary["summaryDTO"]
-        else str(json_summary["summaryDTO"]["averageTemperature"]) + ","
-    )
-    csv_record += (
-        empty_record
-        if "minTemperature" not in json_summary["summaryDTO"]
-        else str(json_summary["summaryDTO"]["minTemperature"]) + ","
-    )
-    csv_record += (
-        empty_record
-        if "maxTemperature" not in json_summary["summaryDTO"]
-        else str(json_summary["summaryDTO"]["maxTemperature"]) + ","
-    )
-    csv_record += (
-        empty_record
-        if "activityId" not in a
-        else '"https://connect.garmin.com/modern/activity/'
-             + str(a["activityId"])
-             + '",'
-    )
-    csv_record += (
-        empty_record if "endTimestamp" not in json_summary["summaryDTO"] else ","
-    )
-    csv_record += (
-        empty_record if "beginTimestamp" not in json_summary["summaryDTO"] else ","
-    )
-    csv_record += (
-        empty_record if "endTimestamp" not in json_summary["summaryDTO"] else ","
-    )
-    csv_record += (
-        empty_record
-        if not json_device or "productDisplayName" not in json_device
-        else json_device["productDisplayName"].replace('\u0113','e') + " " + json_device["versionString"] + ","
-    )
-    csv_record += (
-        empty_record
-        if "activityType" not in a
-        else a["activityType"]["typeKey"].title() + ","
-    )
-    csv_record += (
-        empty_record
-        if "eventType" not in a
-        else a["eventType"]["typeKey"].title() + ","
-    )
-    csv_record += (
-        empty_record
-        if "timeZoneUnitDTO" not in json_summary
-        else json_summary["timeZoneUnitDTO"]["timeZone"] + ","
-    )
-    csv_record += (
-        empty_record
-        if "startLatitude" not in json_summary["summaryDTO"]
-        else str(json_summary["summaryDTO"]["startLatitude"]) + ","
-    )
-    csv_record += (
-        empty_record
-        if "startLongitude" not in json_summary["summaryDTO"]
-        else str(json_summary["summaryDTO"]["startLongitude"]) + ","
-    )
-    csv_record += (
-        empty_record
-        if "endLatitude" not in json_summary["summaryDTO"]
-        else str(json_summary["summaryDTO"]["endLatitude"]) + ","
-    )
-    csv_record += (
-        empty_record
-        if "endLongitude" not in json_summary["summaryDTO"]
-        else str(json_summary["summaryDTO"]["endLongitude"]) + ","
-    )
-    csv_record += (
-        empty_record
-        if "gainCorrectedElevation" not in json_summary["summaryDTO"]
-        else ","
-    )
-    csv_record += (
-        empty_record
-        if "lossCorrectedElevation" not in json_summary["summaryDTO"]
-        else ","
-    )
-    csv_record += (
-        empty_record
-        if "maxCorrectedElevation" not in json_summary["summaryDTO"]
-        else ","
-    )
-    csv_record += (
-        empty_record
-        if "minCorrectedElevation" not in json_summary["summaryDTO"]
-        else ","
-    )
-    csv_record += (
-        empty_record
-        if not json_detail or "metricsCount" not in json_detail
-        else str(json_detail["metricsCount"]) + ","
-    )
-    csv_record += "\n"
-
-    return csv_record
-
-
-def csvheader():
-    header = "Activity name,\
-Description,\
-Bike,\
-Begin timestamp,\
-Duration (h:m:s),\
-Moving duration (h:m:s),\
-Distance (km),\
-Average speed (km/h),\
-Average moving speed (km/h),\
-Max. speed (km/h),\
-Elevation loss uncorrected (m),\
-Elevation gain uncorrected (m),\
-Elevation min. uncorrected (m),\
-Elevation max. uncorrected (m),\
-Min. heart rate (bpm),\
-Max. heart rate (bpm),\
-Average heart rate (bpm),\
-Calories,\
-Avg. cadence (rpm),\
-Max. cadence (rpm),\
-Strokes,\
-Avg. temp (°C),\
-Min. temp (°C),\
-Max. temp (°C),\
-Map,\
-End timestamp,\
-Begin timestamp (ms),\
-End timestamp (ms),\
-Device,\
-Activity type,\
-Event type,\
-Time zone,\
-Begin latitude (°DD),\
-Begin longitude (°DD),\
-End latitude (°DD),\
-End longitude (°DD),\
-Elevation gain corrected (m),\
-Elevation loss corrected (m),\
-Elevation max. corrected (m),\
-Elevation min. corrected (m),\
-Sample count\n"
-    return header
+
+def hasartifact(filename):
+    """True if a JSON artifact was written by an earlier run, as a file or into the pack."""
+    if PACK:
+        return PACK.has(basename(filename))
+    return isfile(filename)
+
+
+def readdetail(filename):
+    """
+    The fields of the activity details the csv needs (gcecolumns.DETAIL_FIELDS), scanned
+    from the stored details without parsing them; None if they are not there (anymore).
+    """
+    if PACK:
+        text = PACK.get(basename(filename))
+        return gceutils.jsonfields([text.encode("utf-8")], gcecolumns.DETAIL_FIELDS) if text is not None else None
+    try:
+        with open(filename, "rb") as detail_file:
+            return gceutils.jsonfields(iter(lambda: detail_file.read(CHUNK_SIZE), b""), gcecolumns.DETAIL_FIELDS)
+    except OSError:
+        return None
+
+
+def fetchdetail(url, filename):
+    """
+    Download the details of an activity into filename, or the pack, as they arrive. They
+    hold every sample of the activity, tens of MB for a long one, and the csv needs a
+    number or two of it: the details are never parsed, the fields are scanned from the file.
+    :return: the fields of readdetail(), None if Garmin has no details
+    """
+    if not PACK:
+        return readdetail(filename) if download_to_file(url, filename) else None
+    with tempfile.SpooledTemporaryFile(DETAIL_SPOOL_SIZE) as detail_data:
+        if not download_into(url, detail_data):
+            return None
+        detail_data.seek(0)
+        PACK.putfile(basename(filename), detail_data)
+        detail_data.seek(0)
+        return gceutils.jsonfields(iter(lambda: detail_data.read(CHUNK_SIZE), b""), gcecolumns.DETAIL_FIELDS)
+
+
+def createjson(directory, stractId, actsum, have=(), fetch=gceindex.JSON_ARTIFACTS):
+    """
+    Fetch and persist the app info, details and gear of an activity.
+    :param actsum: the summary JSON text, None if the summary is not fetched
+    :param have: artifacts (gceindex names) fetched by an earlier run; they are read from
+                 the export directory and only fetched again if the file is gone
+    :param fetch: the artifacts of the fetch plan (gceindex names), the others stay None;
+                  the app info needs the summary
+    :return: the summary, gear, device and detail JSON
+    """
+    if isinstance(actsum, bytes):
+        actsum = actsum.decode()
+    # a summary written by an earlier run may hold more than one document, the last one counts
+    json_summary = gceutils.lastjson(actsum) if actsum else None
+    log.debug(json_summary)
+    json_device = readjson(directory + sep + stractId + "_app_info.json") if gceindex.APP_INFO in have else None
+    json_detail = readdetail(directory + sep + stractId + "_activity_detail.json") if gceindex.DETAIL in have else None
+    json_gear = readjson(directory + sep + stractId + "_gear_detail.json") if gceindex.GEAR in have else None
+    fetch_device = gceindex.APP_INFO in fetch and json_device is None and json_summary is not None
+    fetch_detail = gceindex.DETAIL in fetch and json_detail is None
+    fetch_gear = gceindex.GEAR in fetch and json_gear is None
+    installation_id = json_summary["metadataDTO"]["deviceApplicationInstallationId"] if fetch_device else None
+    # most activities come from the same few devices, ask Garmin once per installation
+    device_detail = DEVICE_CACHE.get(installation_id) if DEVICE_CACHE and fetch_device else None
+    # with the asyncio engine the device and gear lookups are on the wire at the same time as
+    # the details; those are streamed to disk, a prefetch would hold all of them in memory
+    if fetch_device and device_detail is None:
+        prefetch(URL_DEVICE_DETAIL + str(installation_id))
+    if fetch_gear and not GEAR_RESOLVER:
+        prefetch(URL_GEAR_DETAIL + "activityId=" + stractId)
+    if fetch_device:
+        if device_detail is None:
+            log.debug("Device detail URL: " + URL_DEVICE_DETAIL + str(installation_id))
+            device_detail = http_req(URL_DEVICE_DETAIL + str(installation_id))
+            if device_detail:
+                device_detail = device_detail.decode()
+                if DEVICE_CACHE:
+                    DEVICE_CACHE.put(installation_id, device_detail)
+        if device_detail:
+            writejson(directory + sep + stractId + "_app_info.json", device_detail)
+            json_device = json.loads(device_detail)
+            log.debug(json_device)
+        else:
+            log.debug("Retrieving Device Details failed.")
+            json_device = None
+    if fetch_detail:
+        log.debug("Activity details URL: " + URL_GC_ACTIVITY + stractId + "/details")
+        try:
+            json_detail = fetchdetail(URL_GC_ACTIVITY + stractId + "/details",
+                                      directory + sep + stractId + "_activity_detail.json")
+            log.debug(json_detail)
+        except Exception as error:
+            print("Retrieving Activity Details failed. Reason: " + str(error))
+            json_detail = None
+    if fetch_gear:
+        user_profile_pk = json_summary.get("userProfileId") if json_summary else None
+        gear_detail = GEAR_RESOLVER.gear(stractId, user_profile_pk) if GEAR_RESOLVER else None
+        if gear_detail is None:
+            log.debug("Gear details URL: " + URL_GEAR_DETAIL + "activityId=" + stractId)
+            gear_detail = http_req(URL_GEAR_DETAIL + "activityId=" + stractId)
+        try:
+            if isinstance(gear_detail, bytes):
+                gear_detail = gear_detail.decode()
+            writejson(directory + sep + stractId + "_gear_detail.json", gear_detail)
+            json_gear = json.loads(gear_detail)
+            log.debug(json_gear)
+        except Exception as error:
+            print("Retrieving Gear Details failed. Error: " + str(error))
+            json_gear = None
+
+    return json_summary, json_gear, json_device, json_detail
 
 
 def buildFriendlyFilename(a, json_summary, json_gear, json_device, json_detail, ARGS):
     """
     crerates a friendly, readable string for the filename in workflowmode
+    without the summary (not in the --fetch plan) the start time and elevation gain are taken
+    from the entry of the activity list, a missing device or value is left out
     """
     empty_record = ""
     seperator = "-"
     file_name = ""
+    summary_dto = json_summary["summaryDTO"] if json_summary else a
     
     file_name += (
         empty_record
-        if "startTimeLocal" not in json_summary["summaryDTO"]
-        else json_summary["summaryDTO"]["startTimeLocal"][:19].replace(':','-')
+        if not summary_dto.get("startTimeLocal")
+        else summary_dto["startTimeLocal"][:19].replace(' ', 'T').replace(':','-')
     )
     file_name += seperator
     file_name += (
@@ -470,8 +640,8 @@ def buildFriendlyFilename(a, json_summary, json_gear, json_device, json_detail,
     file_name += seperator
     file_name += (
         empty_record
-        if "elevationGain" not in json_summary["summaryDTO"]
-        else "%dhm" % (json_summary["summaryDTO"]["elevationGain"])
+        if summary_dto.get("elevationGain") is None
+        else "%dhm" % (summary_dto["elevationGain"])
     )
     
     file_name += '.fit'
@@ -480,8 +650,47 @@ def buildFriendlyFilename(a, json_summary, json_gear, json_device, json_detail,
 #    gceutils.printverbose(ARGS.verbose, 'Friendly name: ' + file_name)
     return file_name
 
-COOKIE_JAR = http.cookiejar.CookieJar()
-OPENER = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(COOKIE_JAR))
+
+class _ConnectTimeout:
+    """
+    Connection of the urllib opener that connects within CONNECT_TIMEOUT; urllib knows one
+    timeout only, it is the read timeout once the connection is there.
+    """
+
+    def connect(self):
+        read_timeout = self.timeout
+        if CONNECT_TIMEOUT is not None:
+            self.timeout = CONNECT_TIMEOUT
+        try:
+            super().connect()
+        finally:
+            self.timeout = read_timeout
+        self.sock.settimeout(read_timeout)
+
+
+class _HTTPConnection(_ConnectTimeout, http.client.HTTPConnection):
+    pass
+
+
+class _HTTPSConnection(_ConnectTimeout, http.client.HTTPSConnection):
+    pass
+
+
+class _HTTPHandler(urllib.request.HTTPHandler):
+    def http_open(self, req):
+        return self.do_open(_HTTPConnection, req)
+
+
+class _HTTPSHandler(urllib.request.HTTPSHandler):
+    def https_open(self, req):
+        return self.do_open(_HTTPSConnection, req, context=self._context)
+
+
+USER_AGENT = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, \
+        like Gecko) Chrome/54.0.2816.0 Safari/537.36"
+# a MozillaCookieJar works like a plain CookieJar, but can store the session in a file
+COOKIE_JAR = http.cookiejar.MozillaCookieJar()
+OPENER = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(COOKIE_JAR), _HTTPHandler, _HTTPSHandler)
 WEBHOST = "https://connect.garmin.com"
 REDIRECT = "https://connect.garmin.com/modern/"
 BASE_URL = "https://connect.garmin.com/en-US/signin"
@@ -530,3 +739,4 @@ URL_GC_TCX_ACTIVITY = "https://connect.garmin.com/modern/proxy/download-service/
 URL_GC_ORIGINAL_ACTIVITY = "http://connect.garmin.com/proxy/download-service/files/activity/"
 URL_DEVICE_DETAIL = "https://connect.garmin.com/modern/proxy/device-service/deviceservice/app-info/"
 URL_GEAR_DETAIL = "https://connect.garmin.com/modern/proxy/gear-service/gear/filterGear?"
+URL_GEAR_ACTIVITIES = "https://connect.garmin.com/modern/proxy/activitylist-service/activities/"
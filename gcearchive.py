@@ -0,0 +1,194 @@
+"""
+incremental archive of the garmin connect export
+
+The archive is updated, not written again: a file of the export directory is added only
+if the archive has no member of that name, size and modification time (to the two
+seconds a ZIP keeps). Files are deflated in worker
+processes; the compressed data is spliced into the archive as it is, since zipfile can
+only write members it compresses itself. Files that are compressed already (FIT, ZIP,
+the pack of --storage pack) are stored.
+
+A member whose file changed is replaced in the central directory, and the new data is
+written after the new files of the run, as are the files that are not of one activity.
+The files that change every run (activities.csv, activity_list.json, the pack, the SQLite
+files) thus end up at the end of the archive, and
+the next run writes over their old data instead of adding to it. Old data anywhere else
+is unused space; once that is more than COMPACT_RATIO of the archive, the live members are
+copied into a new archive as they are.
+
+"""
+import logging
+import os
+import struct
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from os.path import isdir, isfile
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile, ZipInfo
+
+log = logging.getLogger(__name__)
+
+# compressing these again costs time and gains nothing
+STORED_SUFFIXES = (".fit", ".zip", ".pack", ".gz", ".zst")
+# fewer files than this are deflated in this process, starting workers would take longer
+PARALLEL_MINIMUM = 16
+# the archive is compacted once unused space is more than this share of it
+COMPACT_RATIO = 0.25
+# bytes copied at a time when compacting
+COPY_CHUNK = 1024 * 1024
+
+
+def _deflate(job):
+    """Deflate a file (in a worker process) into a raw stream for a ZIP member."""
+    path, level = job
+    with open(path, "rb") as member_file:
+        data = member_file.read()
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return zlib.crc32(data), len(data), compressor.compress(data) + compressor.flush()
+
+
+def _splice(zf, arcname, path, crc, size, data):
+    """Append a member with data deflated elsewhere to the archive zf (open in mode 'a')."""
+    zinfo = ZipInfo.from_file(path, arcname)
+    zinfo.compress_type = ZIP_DEFLATED
+    zinfo.CRC = crc
+    zinfo.file_size = size
+    zinfo.compress_size = len(data)
+    zinfo.flag_bits = 0
+    # zipfile has no call for precompressed data; this is what ZipFile.write does after
+    # compressing, minus the compressing
+    zf.fp.seek(zf.start_dir)
+    zinfo.header_offset = zf.start_dir
+    zf.fp.write(zinfo.FileHeader())
+    zf.fp.write(data)
+    zf.start_dir = zf.fp.tell()
+    zf.filelist.append(zinfo)
+    zf.NameToInfo[arcname] = zinfo
+    zf._didModify = True
+
+
+def _stamp(path):
+    """Size and modification time of a file as a member of it would have them."""
+    st = os.stat(path)
+    date_time = time.localtime(st.st_mtime)[0:6]
+    # a ZIP keeps the seconds halved
+    return st.st_size, date_time[0:5] + (date_time[5] // 2 * 2,)
+
+
+def _memberend(zf, zinfo):
+    """The offset right after the local header, data and data descriptor of a member."""
+    zf.fp.seek(zinfo.header_offset + 26)
+    name_length, extra_length = struct.unpack("<HH", zf.fp.read(4))
+    end = zinfo.header_offset + 30 + name_length + extra_length + zinfo.compress_size
+    if zinfo.flag_bits & 0x08:
+        zf.fp.seek(end)
+        end += 16 if zf.fp.read(4) == b"PK\x07\x08" else 12
+    return end
+
+
+def _deadspace(zf):
+    """Bytes before the central directory that belong to no member."""
+    return zf.start_dir - sum(_memberend(zf, zinfo) - zinfo.header_offset for zinfo in zf.filelist)
+
+
+def compactarchive(dst):
+    """Copy the members of the archive dst, without the unused space between them, into a new dst."""
+    started = time.time()
+    with ZipFile(dst) as old, ZipFile(dst + ".tmp", "w") as new:
+        new.comment = old.comment
+        for zinfo in sorted(old.infolist(), key=lambda member: member.header_offset):
+            remaining = _memberend(old, zinfo) - zinfo.header_offset
+            old.fp.seek(zinfo.header_offset)
+            zinfo.header_offset = new.fp.tell()
+            while remaining:
+                chunk = old.fp.read(min(COPY_CHUNK, remaining))
+                new.fp.write(chunk)
+                remaining -= len(chunk)
+            new.filelist.append(zinfo)
+            new.NameToInfo[zinfo.filename] = zinfo
+        new.start_dir = new.fp.tell()
+        new._didModify = True
+    os.replace(dst + ".tmp", dst)
+    log.info("Archive compacted: " + dst + " in " + "{0:.2f}".format(time.time() - started) + "s")
+
+
+def updatearchive(dst, src, level=6, workers=None):
+    """
+    Add the files of src that are new or changed to the archive dst, create it if needed.
+    :param level: deflate level of the members, 0 stores all of them
+    :param workers: number of worker processes for deflating, default one per core
+    :return: the number of members added
+    """
+    log.debug("In updatearchive, preparing to archive the new files in " + src)
+    dirpart = os.path.dirname(dst)
+    if dirpart and not isdir(dirpart):
+        os.makedirs(dirpart)
+        log.debug("Archive directory " + dirpart + " created")
+    abs_src = os.path.abspath(src)
+    abs_dst = os.path.abspath(dst)
+    archived = {}
+    if isfile(dst):
+        with ZipFile(dst) as zf:
+            archived = {zinfo.filename: (zinfo.file_size, zinfo.date_time) for zinfo in zf.infolist()}
+    # new files first, the changed ones last, so the files that change every run stay at the end
+    stored = ([], [])
+    deflated = ([], [])
+    for dirname, subdirs, files in os.walk(src):
+        for filename in files:
+            absname = os.path.abspath(os.path.join(dirname, filename))
+            if absname == abs_dst:
+                continue
+            arcname = absname[len(abs_src) + 1:].replace(os.sep, "/")
+            member = archived.get(arcname)
+            # the size alone misses files rewritten in place, like the pages of a SQLite file
+            if member == _stamp(absname):
+                continue
+            # the files of an activity start with its id and are written once, the rest of the
+            # export directory (csv, activity list, pack, indexes) changes with every run
+            group = 0 if member is None and filename[:1].isdigit() else 1
+            if level == 0 or filename.lower().endswith(STORED_SUFFIXES):
+                stored[group].append((absname, arcname))
+            else:
+                deflated[group].append((absname, arcname))
+    added = sum(len(group) for group in stored + deflated)
+    log.info(str(added) + " new or changed files for the archive, " + str(len(archived)) + " archived already")
+    if not added and isfile(dst):
+        return 0
+    started = time.time()
+    jobs = [(absname, level) for absname, arcname in deflated[0] + deflated[1]]
+    with ZipFile(dst, "a") as zf:
+        for absname, arcname in stored[1] + deflated[1]:
+            if arcname in zf.NameToInfo:
+                # the file changed, the new member takes the place of the old one
+                zf.filelist.remove(zf.NameToInfo.pop(arcname))
+        # write over the end of the archive that only held replaced members, usually the
+        # changed files of the last run
+        live_end = max((_memberend(zf, zinfo) for zinfo in zf.filelist), default=zf.start_dir)
+        if live_end < zf.start_dir:
+            log.debug("reusing " + str(zf.start_dir - live_end) + " bytes at the end of the archive")
+            zf.start_dir = live_end
+        if len(jobs) < PARALLEL_MINIMUM:
+            _writeall(zf, stored, deflated, map(_deflate, jobs))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                _writeall(zf, stored, deflated, executor.map(_deflate, jobs, chunksize=8))
+        dead = _deadspace(zf)
+        size = zf.start_dir
+    log.info("Archive updated: " + dst + " in " + "{0:.2f}".format(time.time() - started) + "s")
+    if dead > COMPACT_RATIO * size:
+        log.info(str(dead) + " of " + str(size) + " bytes of the archive are unused, compacting it")
+        compactarchive(dst)
+    return added
+
+
+def _writeall(zf, stored, deflated, results):
+    """Write the new members, then the changed ones; results are the deflated data of both in this order."""
+    for group in (0, 1):
+        for (absname, arcname), (crc, size, data) in zip(deflated[group], islice(results, len(deflated[group]))):
+            log.debug("zipping " + absname + " as " + arcname)
+            _splice(zf, arcname, absname, crc, size, data)
+        # stored last: the biggest of the changing files, the pack, is then the very last member
+        for absname, arcname in stored[group]:
+            log.debug("storing " + absname + " as " + arcname)
+            zf.write(absname, arcname, ZIP_STORED)
@@ -2,13 +2,64 @@
 utility functions used in the garmin connect export
 
 """
+import argparse
 import os.path
+from datetime import date
+
+
+def isodate(text):
+    """A --start-date or --end-date value, YYYY-MM-DD."""
+    try:
+        return date.fromisoformat(text).isoformat()
+    except ValueError:
+        raise argparse.ArgumentTypeError("'" + text + "' is not a date like 2020-03-31")
+
+
+# the data file formats of --format
+FORMAT_CHOICES = ("gpx", "tcx", "original")
+
+
+def formatlist(text):
+    """A --format value, one or more comma separated FORMAT_CHOICES; repeated ones are dropped."""
+    names = []
+    for name in text.split(","):
+        name = name.strip()
+        if name and name not in names:
+            names.append(name)
+    unknown = [name for name in names if name not in FORMAT_CHOICES]
+    if unknown or not names:
+        raise argparse.ArgumentTypeError("'" + text + "' is not a list of " + ", ".join(FORMAT_CHOICES))
+    return names
+
+
+# what --fetch can ask for per activity: the data file in --format and the JSON artifacts
+FETCH_CHOICES = ("data", "summary", "device", "details", "gear")
+
+
+def fetchplan(text):
+    """A --fetch value, comma separated FETCH_CHOICES; the device needs the summary, which is added."""
+    names = [name.strip() for name in text.split(",") if name.strip()]
+    unknown = [name for name in names if name not in FETCH_CHOICES]
+    if unknown or not names:
+        raise argparse.ArgumentTypeError("'" + text + "' is not a list of " + ", ".join(FETCH_CHOICES))
+    if "device" in names and "summary" not in names:
+        names.append("summary")
+    return names
+
 
 def addargs(parser, activities_directory):
     # global ARGS
     parser.add_argument(
         "--archive",
-        help="path with filename to create/append an archive",
+        help="path with filename to create/append an archive; only new or changed files are added",
+    )
+    parser.add_argument(
+        "--archive-level",
+        type=int,
+        choices=range(10),
+        default=6,
+        metavar="{0-9}",
+        help="deflate level of the archived files, 0 just stores them; FIT and ZIP files are always stored (default: 6)",
     )
     parser.add_argument(
         "--username",
@@ -20,6 +71,10 @@ def addargs(parser, activities_directory):
         help="your Garmin Connect password (otherwise, you will be prompted)",
         nargs="?",
     )
+    parser.add_argument(
+        "--session-file",
+        help="store the login session in this file and reuse it while Garmin accepts it",
+    )
     parser.add_argument(
         "-c",
         "--count",
@@ -27,6 +82,29 @@ def addargs(parser, activities_directory):
         default="1",
         help="number of recent activities to download, or 'all' (default: 1)",
     )
+    parser.add_argument(
+        "--incremental",
+        help="download the newest activities until the first one that is already exported (ignores --count)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--start-date",
+        type=isodate,
+        metavar="YYYY-MM-DD",
+        help="only the activities from this day on; Garmin filters the activity list, --count counts the "
+             "matching activities",
+    )
+    parser.add_argument(
+        "--end-date",
+        type=isodate,
+        metavar="YYYY-MM-DD",
+        help="only the activities up to and including this day",
+    )
+    parser.add_argument(
+        "--activity-type",
+        metavar="TYPE",
+        help="only the activities of this type, as Garmin names it, e.g. cycling, running, swimming, hiking",
+    )
     parser.add_argument(
         "-e",
         "--external",
@@ -44,10 +122,11 @@ def addargs(parser, activities_directory):
     parser.add_argument(
         "-f",
         "--format",
-        nargs="?",
-        choices=["gpx", "tcx", "original"],
+        type=formatlist,
         default="gpx",
-        help="export format; can be 'gpx', 'tcx', or 'original' (default: 'gpx')",
+        metavar="{gpx,tcx,original}",
+        help="export format; can be 'gpx', 'tcx', or 'original', or several comma separated, e.g. "
+             "'original,gpx' downloads both in one run (default: 'gpx')",
     )
     parser.add_argument(
         "-d",
@@ -70,11 +149,138 @@ def addargs(parser, activities_directory):
         help="if downloading activity(format: 'original' and --unzip): copy the file, given a friendly filename, to this directory (default: not copying)",
     )   
     
+    parser.add_argument(
+        "--fetch",
+        type=fetchplan,
+        default=",".join(FETCH_CHOICES),
+        metavar="LIST",
+        help="what to fetch per activity, comma separated: data (the files in --format), summary, device, details, "
+             "gear; e.g. 'data' for the files only. The csv leaves the columns of the rest empty (default: all)",
+    )
     parser.add_argument(
         "--delete",
         nargs="*",
         help="list the .types you want deleted before the archive is created. Example --delete .csv .json.",
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of activities to download in parallel (default: 1)",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=5.0,
+        help="requests per second to each Garmin host to start with, 0 for no limit (default: 5)",
+    )
+    parser.add_argument(
+        "--max-rate",
+        type=float,
+        default=20.0,
+        help="the request rate grows up to this while Garmin answers fine and backs off on errors (default: 20)",
+    )
+    parser.add_argument(
+        "--index",
+        help="keep a sync index in the export directory to decide what to skip or fetch again",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--device-cache-ttl",
+        type=float,
+        default=24,
+        metavar="HOURS",
+        help="keep the device info of an installation this long in the export directory, 0 to ask every time (default: 24)",
+    )
+    parser.add_argument(
+        "--bulk-gear",
+        help="resolve the gear of all activities from your gear list instead of asking per activity",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--keepalive",
+        help="reuse HTTP connections to Garmin Connect instead of opening one per request",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=["urllib", "asyncio"],
+        default="urllib",
+        help="HTTP engine; 'asyncio' keeps many requests in flight from one thread (default: 'urllib')",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=100,
+        help="with --engine asyncio: maximum number of requests in flight (default: 100)",
+    )
+    parser.add_argument(
+        "--connect-timeout",
+        type=float,
+        default=10,
+        metavar="SECONDS",
+        help="give up on a connection to Garmin Connect after this long (default: 10)",
+    )
+    parser.add_argument(
+        "--read-timeout",
+        type=float,
+        default=60,
+        metavar="SECONDS",
+        help="give up on a response that stalls this long (default: 60)",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=3,
+        help="retry a failed download this often, waiting longer each time; interrupted data files are resumed (default: 3)",
+    )
+    parser.add_argument(
+        "--columns",
+        help="comma separated keys of the columns of activities.csv, in this order (default: all); "
+             "the keys are listed in gcecolumns.py, e.g. name,begin,distance,device",
+    )
+    parser.add_argument(
+        "--storage",
+        choices=["files", "pack"],
+        default="files",
+        help="where the JSON of the activities goes: one file each, or compressed into artifacts.pack "
+             "(default: 'files')",
+    )
+    parser.add_argument(
+        "--pack-compression",
+        choices=["gzip", "zstd"],
+        default="gzip",
+        help="with --storage pack: compression of new records, zstd needs the zstandard package (default: 'gzip')",
+    )
+    parser.add_argument(
+        "--summary-db",
+        help="keep the activities with typed fields in activities.sqlite as well, one row per activity",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--rebuild-csv",
+        help="write activities.csv (and with --summary-db activities.sqlite) of --directory again from the JSON "
+             "files of earlier runs, offline",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--report",
+        metavar="FILE",
+        help="write the counts, bytes and times of the requests by endpoint and of the stages of the run to "
+             "this JSON file (default: export_report.json in the export directory)",
+    )
+    parser.add_argument(
+        "--prometheus",
+        metavar="FILE",
+        help="write the same metrics in the Prometheus text format as well, e.g. into the directory of the "
+             "textfile collector of the node exporter",
+    )
+    parser.add_argument(
+        "--base-url",
+        metavar="URL",
+        help="send the requests to this server instead of Garmin Connect, e.g. http://127.0.0.1:8765 for the "
+             "stand-in gcemock.py",
+    )
     parser.add_argument("--debug", help="turn on debugging log", action="store_true")
     parser.add_argument("--verbose", help="increase output verbosity", action="store_true")
     parser.add_argument("--version", help="print version and exit", action="store_true")
@@ -0,0 +1,362 @@
+"""
+asyncio HTTP engine for the garmin connect export
+
+The engine runs one event loop in a background thread and speaks HTTP/1.1 itself, so it
+needs nothing outside the standard library. Requests are handed to the loop from any
+thread with submit() (returns a concurrent.futures.Future) or request() (blocks until the
+response is there), so hundreds of requests can be in flight while only the loop thread
+does the network I/O. It shares the http.cookiejar of gceaccess and answers like
+gceaccess.http_req: the body as bytes, "" for 204 and urllib.error.HTTPError for 4xx/5xx.
+stream() returns the response before the body is read, for data files.
+
+"""
+import asyncio
+import http.client
+import io
+import logging
+import ssl
+import threading
+import urllib.error
+import urllib.parse
+
+import gcepool
+
+log = logging.getLogger(__name__)
+
+
+class _Body:
+    """
+    The body of one response, read in pieces: by Content-Length, chunked or until the
+    connection closes. When the body is read to the end or closed, release() gives the
+    connection back (or closes it) and frees the slots the request held.
+    """
+
+    def __init__(self, engine, reader, headers, status, method, keep, release):
+        self._engine = engine
+        self._reader = reader
+        self._release = release
+        self.keep = keep
+        self._chunked = False
+        self._remaining = None
+        if method == "HEAD" or status in (204, 304) or 100 <= status < 200:
+            self._remaining = 0
+        elif headers.get("Transfer-Encoding", "").lower() == "chunked":
+            self._chunked = True
+            self._chunk_left = 0
+        elif "Content-Length" in headers:
+            self._remaining = int(headers["Content-Length"])
+        else:
+            # read until the server closes the connection
+            self.keep = False
+        self.done = False
+        if self._remaining == 0:
+            self._finish()
+
+    def _finish(self, keep=None):
+        if not self.done:
+            self.done = True
+            self._release(self.keep if keep is None else keep)
+
+    async def read(self, amt=65536):
+        """Return up to amt bytes of the body, b"" at the end."""
+        if self.done:
+            return b""
+        try:
+            data = await self._read(amt)
+        except asyncio.IncompleteReadError:
+            self._finish(False)
+            raise ConnectionResetError("connection closed during the response")
+        except BaseException:
+            self._finish(False)
+            raise
+        if not data:
+            self._finish()
+        return data
+
+    async def _read(self, amt):
+        wait = self._engine.timed
+        if self._chunked:
+            if self._chunk_left == 0:
+                size = int((await wait(self._reader.readline())).split(b";")[0].strip(), 16)
+                if size == 0:
+                    # skip the trailer
+                    while (await wait(self._reader.readline())) not in (b"\r\n", b"\n", b""):
+                        pass
+                    return b""
+                self._chunk_left = size
+            data = await wait(self._reader.readexactly(min(amt, self._chunk_left)))
+            self._chunk_left -= len(data)
+            if self._chunk_left == 0:
+                await wait(self._reader.readline())
+            return data
+        if self._remaining is None:
+            return await wait(self._reader.read(amt))
+        if self._remaining == 0:
+            return b""
+        # whatever arrived is handed out, so a broken transfer can be resumed from there
+        data = await wait(self._reader.read(min(amt, self._remaining)))
+        if not data:
+            raise asyncio.IncompleteReadError(b"", self._remaining)
+        self._remaining -= len(data)
+        if self._remaining == 0:
+            self._finish()
+        return data
+
+    async def readall(self):
+        chunks = []
+        while True:
+            data = await self.read()
+            if not data:
+                return b"".join(chunks)
+            chunks.append(data)
+
+    async def close(self):
+        """Give up on the rest of the body; the connection can't be reused then."""
+        self._finish(False)
+
+
+class StreamResponse:
+    """
+    Blocking view of a response of the engine for the calling thread, with the part of the
+    http.client.HTTPResponse interface the exporter uses: status, getheader(), read(), close().
+    """
+
+    def __init__(self, engine, status, reason, headers, body):
+        self._engine = engine
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self._body = body
+
+    def getcode(self):
+        return self.status
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+    def read(self, amt=None):
+        if amt is None:
+            return self._engine.call(self._body.readall())
+        return self._engine.call(self._body.read(amt))
+
+    def close(self):
+        self._engine.call(self._body.close())
+
+
+class AsyncEngine:
+    def __init__(self, cookie_jar, user_agent, concurrency=100, rate_limiter=None, per_host=10,
+                 connect_timeout=None, read_timeout=None):
+        """
+        :param cookie_jar: the http.cookiejar shared with the urllib opener
+        :param user_agent: User-Agent header sent with every request
+        :param concurrency: maximum number of requests in flight at the same time
+        :param rate_limiter: optional gcerate.HostRateLimiter
+        :param per_host: maximum number of open connections to one host; further requests
+                         wait for a connection to become idle
+        :param connect_timeout: seconds to wait for a connection, None waits forever
+        :param read_timeout: seconds to wait for each piece of a response, None waits forever
+        """
+        self.cookie_jar = cookie_jar
+        self.user_agent = user_agent
+        self.concurrency = concurrency
+        self.rate_limiter = rate_limiter
+        self.per_host = per_host
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.opened = 0
+        self.reused = 0
+        self.requests = 0
+        self._host_slots = {}
+        self._ssl = ssl.create_default_context()
+        # idle keep-alive connections per (scheme, host, port)
+        self._idle = {}
+        self._loop = asyncio.new_event_loop()
+        self._semaphore = None
+        self._thread = threading.Thread(target=self._run, name="gceasync", daemon=True)
+        self._started = threading.Event()
+        self._thread.start()
+        self._started.wait()
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._loop.call_soon(self._started.set)
+        self._loop.run_forever()
+
+    def call(self, coroutine):
+        """Run a coroutine on the engine's loop and wait for its result."""
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    def submit(self, url, post=None, headers=None):
+        """Start a request on the engine's loop and return a concurrent.futures.Future."""
+        return asyncio.run_coroutine_threadsafe(self.fetch(url, post, headers), self._loop)
+
+    def request(self, url, post=None, headers=None):
+        """Blocking request, same result as gceaccess.http_req."""
+        return self.submit(url, post, headers).result()
+
+    def stream(self, url, headers=None):
+        """
+        Blocking GET that returns a StreamResponse as soon as the headers are there; the
+        caller reads the body and closes it. 4xx/5xx raise urllib.error.HTTPError.
+        """
+        status, reason, response_headers, body, url = self.call(self._open(url, None, headers))
+        if status >= 400:
+            error_body = self.call(body.readall())
+            raise urllib.error.HTTPError(url, status, reason, response_headers, io.BytesIO(error_body))
+        return StreamResponse(self, status, reason, response_headers, body)
+
+    def stats(self):
+        """Connections opened versus requests served, to see whether keep-alive is working."""
+        return {"opened": self.opened, "reused": self.reused, "requests": self.requests}
+
+    def close(self):
+        """Close the idle connections and stop the loop thread."""
+        self.call(self._closeidle())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    async def _closeidle(self):
+        for connections in self._idle.values():
+            for reader, writer in connections:
+                writer.close()
+        self._idle.clear()
+
+    async def timed(self, awaitable, timeout=None):
+        """Await with the read timeout; a timeout raises the builtin TimeoutError like a socket does."""
+        timeout = self.read_timeout if timeout is None else timeout
+        if timeout is None:
+            return await awaitable
+        try:
+            return await asyncio.wait_for(awaitable, timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError("timed out after " + str(timeout) + "s")
+
+    async def fetch(self, url, post=None, headers=None):
+        """Make the request, follow redirects and return the body like gceaccess.http_req."""
+        status, reason, response_headers, body, url = await self._open(url, post, headers)
+        body = await body.readall()
+        if status == 204:
+            # For activities without GPS coordinates, there is no GPX download (204 = no content);
+            # "" like gceaccess.http_req, the caller decides what to do about it
+            log.info("No GPX activity data...")
+            return ""
+        elif status >= 400:
+            raise urllib.error.HTTPError(url, status, reason, response_headers, io.BytesIO(body))
+        elif status != 200:
+            raise Exception("Bad return code (" + str(status) + ") for: " + url)
+        return body
+
+    async def _open(self, url, post, headers):
+        """
+        Send the request and follow redirects.
+        :return: status, reason, headers, the unread _Body and the final url
+        """
+        if self.rate_limiter:
+            delay = self.rate_limiter.reserve(url)
+            if delay:
+                await asyncio.sleep(delay)
+        if post:
+            post = urllib.parse.urlencode(post).encode("utf-8")
+        for _ in range(gcepool.MAX_REDIRECTS):
+            request = gcepool.buildrequest(url, post, headers, self.user_agent, self.cookie_jar)
+            try:
+                status, reason, response_headers, body = await self._roundtrip(request)
+            except OSError:
+                if self.rate_limiter:
+                    self.rate_limiter.feedback(url, None)
+                raise
+            if self.rate_limiter:
+                self.rate_limiter.feedback(url, status)
+            gcepool.storecookies(self.cookie_jar, response_headers, request)
+            redirect = gcepool.redirecttarget(url, status, response_headers, post)
+            if redirect:
+                await body.readall()
+                url, post = redirect
+                log.debug("redirected to " + url)
+                continue
+            return status, reason, response_headers, body, url
+        await body.close()
+        raise urllib.error.HTTPError(url, status, "Too many redirects", response_headers, None)
+
+    async def _roundtrip(self, request):
+        """Send one request over a pooled connection of its host."""
+        key, path, all_headers = gcepool.requesttarget(request)
+        lines = [request.get_method() + " " + path + " HTTP/1.1", "Host: " + request.host]
+        all_headers.setdefault("Accept-Encoding", "identity")
+        all_headers.setdefault("Connection", "keep-alive")
+        if request.data is not None:
+            all_headers["Content-Length"] = str(len(request.data))
+        for header_key, header_value in all_headers.items():
+            lines.append(header_key + ": " + header_value)
+        head = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+        if key not in self._host_slots:
+            self._host_slots[key] = asyncio.Semaphore(self.per_host)
+        # both slots are held until the body is read, _Body releases them
+        await self._semaphore.acquire()
+        await self._host_slots[key].acquire()
+        try:
+            return await self._send(key, head, request.data, request.get_method())
+        except BaseException:
+            self._host_slots[key].release()
+            self._semaphore.release()
+            raise
+
+    async def _send(self, key, head, data, method):
+        """Write the request and read the response head, retry once if a reused connection went stale."""
+        scheme, host, port = key
+        for attempt in range(2):
+            idle = self._idle.get(key)
+            reused = bool(idle)
+            if reused:
+                reader, writer = idle.pop()
+                self.reused += 1
+            else:
+                reader, writer = await self.timed(asyncio.open_connection(
+                    host, port, ssl=self._ssl if scheme == "https" else None), self.connect_timeout)
+                self.opened += 1
+            try:
+                writer.write(head + (data or b""))
+                await self.timed(writer.drain())
+                status, reason, response_headers, keep = await self._readhead(reader)
+            except (ConnectionError, asyncio.IncompleteReadError) as error:
+                writer.close()
+                if reused and attempt == 0:
+                    log.debug("stale keep-alive connection to " + host + ", reconnecting")
+                    continue
+                if isinstance(error, asyncio.IncompleteReadError):
+                    raise ConnectionResetError("connection closed during the response")
+                raise
+            except BaseException:
+                writer.close()
+                raise
+            self.requests += 1
+
+            def release(keep_connection, reader=reader, writer=writer):
+                if keep_connection:
+                    self._idle.setdefault(key, []).append((reader, writer))
+                else:
+                    writer.close()
+                self._host_slots[key].release()
+                self._semaphore.release()
+
+            return status, reason, response_headers, _Body(self, reader, response_headers, status, method,
+                                                           keep, release)
+
+    async def _readhead(self, reader):
+        status_line = await self.timed(reader.readline())
+        if not status_line:
+            raise ConnectionResetError("connection closed before the response")
+        version, status, reason = (status_line.decode("latin-1").rstrip("\r\n").split(" ", 2) + [""])[:3]
+        status = int(status)
+        raw_headers = []
+        while True:
+            line = await self.timed(reader.readline())
+            if line in (b"\r\n", b"\n", b""):
+                break
+            raw_headers.append(line)
+        response_headers = http.client.parse_headers(io.BytesIO(b"".join(raw_headers) + b"\r\n"))
+        keep = version == "HTTP/1.1" and response_headers.get("Connection", "").lower() != "close"
+        return status, reason, response_headers, keep
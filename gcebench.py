@@ -0,0 +1,144 @@
+#!/usr/bin/python3
+"""
+throughput benchmark of the garmin connect export
+
+Runs gcexport3.py against the stand-in of gcemock.py for every combination of activity
+count, format and set of extra arguments, each run into a new directory, and reports the
+wall time, activities and requests per second and the peak memory of the export.
+The requests are counted from the run report the export writes.
+
+    python3 gcebench.py --counts 50,200 --formats gpx,original --latency 30 \\
+        --variant "" --variant "--workers 8 --keepalive" --variant "--engine asyncio --workers 8"
+
+"""
+import argparse
+import json
+import os
+import shlex
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from os.path import abspath, dirname, join
+from shutil import rmtree
+
+HERE = dirname(abspath(__file__))
+
+
+def startmock(args):
+    """Start gcemock.py on a free port; return the process and its base URL."""
+    command = [sys.executable, join(HERE, "gcemock.py"), "--port", "0",
+               "--activities", str(max(args.counts)), "--points", str(args.points), "--fit-size", str(args.fit_size),
+               "--latency", str(args.latency), "--jitter", str(args.jitter),
+               "--error-rate", str(args.error_rate), "--truncate-rate", str(args.truncate_rate)]
+    mock = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    line = mock.stdout.readline()
+    if not line.startswith("listening on "):
+        mock.kill()
+        raise Exception("gcemock.py did not start: " + line)
+    return mock, line.split()[-1]
+
+
+def runexport(base_url, count, export_format, variant, keep):
+    """
+    Run one export into a new directory.
+    :return: dict with the wall time, peak RSS (MB, None where unknown), activities and requests
+    """
+    directory = tempfile.mkdtemp(prefix="gcebench_")
+    command = [sys.executable, join(HERE, "gcexport3.py"), "--base-url", base_url,
+               "--username", "bench", "--password", "bench", "-c", str(count), "-f", export_format,
+               "-d", directory, "--rate", "0"] + shlex.split(variant)
+    with tempfile.TemporaryFile("w+") as output:
+        started = time.perf_counter()
+        export = subprocess.Popen(command, stdout=output, stderr=subprocess.STDOUT, text=True)
+        if hasattr(os, "wait4"):
+            status, rusage = os.wait4(export.pid, 0)[1:]
+            export.returncode = os.waitstatus_to_exitcode(status)
+            # kilobytes on Linux, bytes on macOS
+            peak_rss = rusage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+        else:
+            export.wait()
+            peak_rss = None
+        wall = time.perf_counter() - started
+        if export.returncode:
+            output.seek(0)
+            raise Exception("the export failed (" + str(export.returncode) + "): " + " ".join(command) + "\n"
+                            + output.read()[-2000:])
+    with open(join(directory, "export_report.json"), encoding="utf-8") as report_file:
+        report = json.load(report_file)
+    if not keep:
+        rmtree(directory, ignore_errors=True)
+    return {
+        "wall": wall,
+        "peak_rss": peak_rss,
+        "activities": report["downloaded"],
+        "requests": sum(endpoint["count"] for endpoint in report["endpoints"].values()),
+        "bytes": sum(endpoint["bytes"] for endpoint in report["endpoints"].values()),
+        "directory": directory if keep else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="throughput benchmark of gcexport3.py against gcemock.py")
+    parser.add_argument("--counts", default="20,100", help="activity counts to export (default: 20,100)")
+    parser.add_argument("--formats", default="gpx,original", help="formats to export (default: gpx,original)")
+    parser.add_argument("--variant", action="append",
+                        help="extra arguments of the export, e.g. '--workers 8 --keepalive'; repeat for more "
+                             "variants (default: none)")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per combination, the median is reported")
+    parser.add_argument("--points", type=int, default=500, help="track points per activity (default: 500)")
+    parser.add_argument("--fit-size", type=int, default=50000, help="bytes per FIT file (default: 50000)")
+    parser.add_argument("--latency", type=float, default=20, metavar="MS",
+                        help="delay of every answer of the stand-in (default: 20)")
+    parser.add_argument("--jitter", type=float, default=0, metavar="MS", help="random extra delay (default: 0)")
+    parser.add_argument("--error-rate", type=float, default=0, help="share of requests answered with 503")
+    parser.add_argument("--truncate-rate", type=float, default=0, help="share of downloads cut off halfway")
+    parser.add_argument("--json", metavar="FILE", help="write the results to this JSON file as well")
+    parser.add_argument("--keep", help="keep the export directories", action="store_true")
+    args = parser.parse_args()
+    args.counts = [int(count) for count in args.counts.split(",")]
+    formats = args.formats.split(",")
+    variants = args.variant or [""]
+
+    mock, base_url = startmock(args)
+    results = []
+    print("{0:>6} {1:<9} {2:<40} {3:>8} {4:>9} {5:>9} {6:>8}".format(
+        "count", "format", "arguments", "wall s", "act/s", "req/s", "RSS MB"))
+    try:
+        for count in args.counts:
+            for export_format in formats:
+                for variant in variants:
+                    runs = [runexport(base_url, count, export_format, variant, args.keep)
+                            for _ in range(args.repeat)]
+                    wall = statistics.median(run["wall"] for run in runs)
+                    rss = [run["peak_rss"] for run in runs if run["peak_rss"] is not None]
+                    result = {
+                        "count": count,
+                        "format": export_format,
+                        "arguments": variant,
+                        "wall": round(wall, 3),
+                        "activities_per_second": round(runs[0]["activities"] / wall, 2),
+                        "requests_per_second": round(runs[0]["requests"] / wall, 2),
+                        "requests": runs[0]["requests"],
+                        "bytes": runs[0]["bytes"],
+                        "peak_rss_mb": round(max(rss), 1) if rss else None,
+                        "directories": [run["directory"] for run in runs if run["directory"]],
+                    }
+                    results.append(result)
+                    print("{0:>6} {1:<9} {2:<40} {3:>8.2f} {4:>9.2f} {5:>9.2f} {6:>8}".format(
+                        count, export_format, variant[:40], wall, result["activities_per_second"],
+                        result["requests_per_second"], "-" if result["peak_rss_mb"] is None else result["peak_rss_mb"]),
+                        flush=True)
+    finally:
+        mock.kill()
+        mock.wait()
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as json_file:
+            json.dump({"latency_ms": args.latency, "points": args.points, "fit_size": args.fit_size,
+                       "error_rate": args.error_rate, "truncate_rate": args.truncate_rate, "results": results},
+                      json_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""
+on-disk lookup cache for the garmin connect export
+
+A small dictionary of key -> (time, value) that is loaded from a JSON file in the export
+directory, shared by the worker threads and written back with save(). Entries older than
+the time to live are treated as missing.
+
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class TTLCache:
+    def __init__(self, filename, ttl):
+        """
+        :param filename: JSON file the cache is loaded from and saved to
+        :param ttl: time to live of an entry in seconds
+        """
+        self.filename = filename
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._dirty = False
+        self._lock = threading.Lock()
+        try:
+            with open(filename, encoding="utf-8") as cache_file:
+                self._entries = json.load(cache_file)
+            log.debug("loaded " + str(len(self._entries)) + " cache entries from " + filename)
+        except (OSError, ValueError):
+            self._entries = {}
+
+    def get(self, key):
+        """Return the cached value of key, None if it is missing or expired."""
+        with self._lock:
+            entry = self._entries.get(str(key))
+            if entry and time.time() - entry[0] < self.ttl:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[str(key)] = (time.time(), value)
+            self._dirty = True
+
+    def save(self):
+        """Write the cache back (to a temporary file first, so a crash can't leave half a file)."""
+        with self._lock:
+            if not self._dirty:
+                return
+            now = time.time()
+            entries = {key: entry for key, entry in self._entries.items() if now - entry[0] < self.ttl}
+            with open(self.filename + ".tmp", "w", encoding="utf-8") as cache_file:
+                json.dump(entries, cache_file)
+            os.replace(self.filename + ".tmp", self.filename)
+            self._dirty = False
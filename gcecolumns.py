@@ -0,0 +1,226 @@
+"""
+columns of the csv file of the garmin connect export
+
+Every column of activities.csv is described once in COLUMNS: its key for --columns, the
+header, where the value comes from and how it is written. The header and the rows are
+both built from these descriptions, so they can't drift apart. rowbuilder() compiles a
+selection of columns into one function that extracts a whole row.
+
+"""
+import logging
+from datetime import datetime, timedelta
+
+import gceutils
+
+log = logging.getLogger(__name__)
+
+# the sources a column reads from
+ACTIVITY = 0  # the entry of the activity list
+SUMMARY = 1  # the activity summary JSON
+DTO = 2  # the summaryDTO part of the summary
+GEAR = 3  # the gear list JSON
+DEVICE = 4  # the app info JSON
+DETAIL = 5  # the activity detail JSON
+
+
+class Column:
+    def __init__(self, key, header, source, path, convert=str, sqltype="TEXT", typed=None):
+        """
+        :param key: name of the column for --columns, and in the summary database
+        :param header: column heading in the csv file
+        :param source: ACTIVITY, SUMMARY, DTO, GEAR, DEVICE or DETAIL
+        :param path: keys and list indexes from the source to the value, () for the source itself
+        :param convert: turns the value into the cell text; a missing value or None leaves
+                        the cell empty without calling it, and so does convert returning None
+        :param sqltype: the type of the column in the summary database
+        :param typed: turns the value into the native value for the database; by default
+                      TEXT and TIMESTAMP columns use convert and numbers are stored as they are
+        """
+        self.key = key
+        self.header = header
+        self.source = source
+        self.path = tuple(path)
+        self.convert = convert
+        self.sqltype = sqltype
+        if typed is None and sqltype in ("TEXT", "TIMESTAMP"):
+            typed = convert
+        self.typed = typed
+
+
+def _text(value):
+    return value if value else None
+
+
+def _distance(meters):
+    return "{0:.5f}".format(meters / 1000)
+
+
+def _title(type_dto):
+    return type_dto["typeKey"].title()
+
+
+def _map(activity_id):
+    return "https://connect.garmin.com/modern/activity/" + str(activity_id)
+
+
+def _device(json_device):
+    if "productDisplayName" not in json_device:
+        return None
+    return json_device["productDisplayName"].replace('\u0113', 'e') + " " + json_device["versionString"]
+
+
+def _local_time(time_local):
+    """A summary time like 2020-01-20T09:15:00.0 as 2020-01-20 09:15:00, which sqlite3 reads back as datetime."""
+    return str(datetime.fromisoformat(time_local[:19]))
+
+
+def _end_timestamp(summary_dto):
+    if "startTimeLocal" not in summary_dto or "elapsedDuration" not in summary_dto:
+        return None
+    begin = datetime.fromisoformat(summary_dto["startTimeLocal"][:19])
+    return str(begin + timedelta(seconds=round(summary_dto["elapsedDuration"])))
+
+
+def _end_timestamp_ms(summary_dto):
+    if "startTimeGMT" not in summary_dto or "elapsedDuration" not in summary_dto:
+        return None
+    return _timestamp_ms(summary_dto["startTimeGMT"]) + round(summary_dto["elapsedDuration"] * 1000)
+
+
+def _timestamp_ms(time_gmt):
+    """Milliseconds since the epoch of a summary time like 2020-01-20T08:15:00.0 (UTC)."""
+    begin = datetime.fromisoformat(time_gmt[:19])
+    return round((begin - datetime(1970, 1, 1)).total_seconds() * 1000)
+
+
+def _km(meters):
+    return meters / 1000
+
+
+def _kmh(mps):
+    return mps * 3.6
+
+
+COLUMNS = [
+    Column("name", "Activity name", ACTIVITY, ["activityName"], _text),
+    Column("description", "Description", ACTIVITY, ["description"]),
+    Column("bike", "Bike", GEAR, [0, "customMakeModel"]),
+    Column("begin", "Begin timestamp", DTO, ["startTimeLocal"], str, "TIMESTAMP", _local_time),
+    Column("duration", "Duration (h:m:s)", DTO, ["elapsedDuration"], gceutils.hhmmss_from_seconds, "REAL"),
+    Column("moving_duration", "Moving duration (h:m:s)", DTO, ["movingDuration"], gceutils.hhmmss_from_seconds,
+           "REAL"),
+    Column("distance", "Distance (km)", DTO, ["distance"], _distance, "REAL", _km),
+    Column("average_speed", "Average speed (km/h)", DTO, ["averageSpeed"], gceutils.kmh_from_mps, "REAL", _kmh),
+    Column("average_moving_speed", "Average moving speed (km/h)", DTO, ["averageMovingSpeed"],
+           gceutils.kmh_from_mps, "REAL", _kmh),
+    Column("max_speed", "Max. speed (km/h)", DTO, ["maxSpeed"], gceutils.kmh_from_mps, "REAL", _kmh),
+    Column("elevation_loss", "Elevation loss uncorrected (m)", DTO, ["elevationLoss"], str, "REAL"),
+    Column("elevation_gain", "Elevation gain uncorrected (m)", DTO, ["elevationGain"], str, "REAL"),
+    Column("min_elevation", "Elevation min. uncorrected (m)", DTO, ["minElevation"], str, "REAL"),
+    Column("max_elevation", "Elevation max. uncorrected (m)", DTO, ["maxElevation"], str, "REAL"),
+    Column("min_hr", "Min. heart rate (bpm)", DTO, ["minHR"], str, "INTEGER"),
+    Column("max_hr", "Max. heart rate (bpm)", DTO, ["maxHR"], str, "INTEGER"),
+    Column("average_hr", "Average heart rate (bpm)", DTO, ["averageHR"], str, "INTEGER"),
+    Column("calories", "Calories", DTO, ["calories"], str, "REAL"),
+    Column("average_cadence", "Avg. cadence (rpm)", DTO, ["averageBikeCadence"], str, "REAL"),
+    Column("max_cadence", "Max. cadence (rpm)", DTO, ["maxBikeCadence"], str, "REAL"),
+    Column("strokes", "Strokes", DTO, ["totalNumberOfStrokes"], str, "INTEGER"),
+    Column("average_temperature", "Avg. temp (°C)", DTO, ["averageTemperature"], str, "REAL"),
+    Column("min_temperature", "Min. temp (°C)", DTO, ["minTemperature"], str, "REAL"),
+    Column("max_temperature", "Max. temp (°C)", DTO, ["maxTemperature"], str, "REAL"),
+    Column("map", "Map", ACTIVITY, ["activityId"], _map),
+    Column("end", "End timestamp", DTO, [], _end_timestamp, "TIMESTAMP"),
+    Column("begin_ms", "Begin timestamp (ms)", DTO, ["startTimeGMT"], _timestamp_ms, "INTEGER", _timestamp_ms),
+    Column("end_ms", "End timestamp (ms)", DTO, [], _end_timestamp_ms, "INTEGER", _end_timestamp_ms),
+    Column("device", "Device", DEVICE, [], _device),
+    Column("activity_type", "Activity type", ACTIVITY, ["activityType"], _title),
+    Column("event_type", "Event type", ACTIVITY, ["eventType"], _title),
+    Column("time_zone", "Time zone", SUMMARY, ["timeZoneUnitDTO", "timeZone"]),
+    Column("begin_latitude", "Begin latitude (°DD)", DTO, ["startLatitude"], str, "REAL"),
+    Column("begin_longitude", "Begin longitude (°DD)", DTO, ["startLongitude"], str, "REAL"),
+    Column("end_latitude", "End latitude (°DD)", DTO, ["endLatitude"], str, "REAL"),
+    Column("end_longitude", "End longitude (°DD)", DTO, ["endLongitude"], str, "REAL"),
+    Column("elevation_gain_corrected", "Elevation gain corrected (m)", DTO, ["gainCorrectedElevation"], str, "REAL"),
+    Column("elevation_loss_corrected", "Elevation loss corrected (m)", DTO, ["lossCorrectedElevation"], str, "REAL"),
+    Column("max_elevation_corrected", "Elevation max. corrected (m)", DTO, ["maxCorrectedElevation"], str, "REAL"),
+    Column("min_elevation_corrected", "Elevation min. corrected (m)", DTO, ["minCorrectedElevation"], str, "REAL"),
+    Column("samples", "Sample count", DETAIL, ["metricsCount"], str, "INTEGER"),
+]
+
+# the activity details hold every sample of the activity, of all of it only these top level
+# numbers are read (see gceaccess.readdetail); a DETAIL column has one of them as its path
+DETAIL_FIELDS = tuple(sorted({column.path[0] for column in COLUMNS if column.source == DETAIL}))
+
+
+
+def select(keys=None):
+    """
+    The columns for a comma separated list of keys, in that order; all columns without keys.
+    :raise ValueError: for an unknown key
+    """
+    if not keys:
+        return list(COLUMNS)
+    by_key = {column.key: column for column in COLUMNS}
+    columns = []
+    for key in keys.split(","):
+        key = key.strip()
+        if key not in by_key:
+            raise ValueError("unknown column '" + key + "', the columns are: " + ", ".join(by_key))
+        columns.append(by_key[key])
+    return columns
+
+
+def header(columns):
+    return [column.header for column in columns]
+
+
+# the names of the sources in the generated row function, by source number
+_SOURCE_NAMES = ("a", "json_summary", "summary_dto", "json_gear", "json_device", "json_detail")
+
+
+def rowbuilder(columns, typed=False):
+    """
+    Compile the extraction of the columns into the source of one function, so a row costs
+    the lookups it needs and nothing more: no loop over the columns and no call per cell,
+    except for the converters. A converter that fails on odd data leaves its cell empty.
+    Without the summary (not in the --fetch plan) the DTO columns read the entry of the
+    activity list, like the friendly file names; a key it doesn't have leaves the cell empty.
+    :param typed: native values for the summary database instead of cell texts, None if missing
+    :return: a function (a, json_summary, json_gear, json_device, json_detail) -> list of cells
+    """
+    empty = "None" if typed else "''"
+    converters = [column.typed if typed else column.convert for column in columns]
+    lines = [
+        "def row(a, json_summary, json_gear, json_device, json_detail):",
+        "    summary_dto = json_summary.get('summaryDTO') if json_summary else a",
+    ]
+    for number, column in enumerate(columns):
+        cell = "c" + str(number)
+        # missing keys are common, looking before leaping is much cheaper than a KeyError
+        lines += ["    try:", "        " + cell + " = " + _SOURCE_NAMES[column.source]]
+        for key in column.path:
+            if isinstance(key, int):
+                step = cell + "[" + str(key) + "] if " + cell + " and len(" + cell + ") > " + str(key)
+            else:
+                step = cell + ".get(" + repr(key) + ") if " + cell
+            lines.append("        " + cell + " = " + step + " else None")
+        lines += ["    except (AttributeError, KeyError, TypeError):", "        " + cell + " = None"]
+        if converters[number] is None:
+            # a number stored as it is
+            continue
+        if converters[number] is str:
+            lines.append("    " + cell + " = " + empty + " if " + cell + " is None else str(" + cell + ")")
+        else:
+            lines += [
+                "    if " + cell + " is not None:",
+                "        try:",
+                "            " + cell + " = convert" + str(number) + "(" + cell + ")",
+                "        except (KeyError, IndexError, TypeError, ValueError):",
+                "            " + cell + " = None",
+                "    if " + cell + " is None:",
+                "        " + cell + " = " + empty,
+            ]
+    lines.append("    return [" + ", ".join("c" + str(number) for number in range(len(columns))) + "]")
+    namespace = {"convert" + str(number): converter for number, converter in enumerate(converters)}
+    exec(compile("\n".join(lines), "<gcecolumns row>", "exec"), namespace)
+    return namespace["row"]
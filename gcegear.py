@@ -0,0 +1,83 @@
+"""
+bulk gear resolution for the garmin connect export
+
+A user owns a handful of gear items, so instead of one filterGear call per activity the
+resolver fetches the gear list of the user once and, per gear item, the ids of the
+activities it was used for. The mapping activity id -> gear is cached in the export
+directory. An activity that is not in a cached mapping may be newer than the cache, so
+the mapping is built again once per run before the activity is reported without gear.
+
+"""
+import json
+import logging
+import threading
+import urllib.parse
+
+import gceaccess
+import gcecache
+
+log = logging.getLogger(__name__)
+
+# the mapping is refreshed after a day, in case gear was assigned to older activities
+GEAR_CACHE_TTL = 24 * 3600
+
+
+class GearResolver:
+    def __init__(self, filename, ttl=GEAR_CACHE_TTL):
+        self._cache = gcecache.TTLCache(filename, ttl)
+        self._lock = threading.Lock()
+        self._built = False
+        self._gear = None
+        self._activities = None
+        self.requests = 0
+
+    def gear(self, stractid, user_profile_pk):
+        """
+        Return the gear of the activity as JSON text, in the form filterGear?activityId=
+        answers it, or None if the gear can't be resolved in bulk.
+        """
+        if user_profile_pk is None:
+            return None
+        with self._lock:
+            if self._activities is None:
+                self._gear = self._cache.get("gear")
+                self._activities = self._cache.get("activities")
+            if self._activities is None or (stractid not in self._activities and not self._built):
+                try:
+                    self._build(user_profile_pk)
+                except Exception as error:
+                    print("Resolving gear in bulk failed, asking per activity. Error: " + str(error))
+                    return None
+            gear_items = {item["uuid"]: item for item in self._gear}
+            return json.dumps([gear_items[uuid] for uuid in self._activities.get(stractid, [])
+                               if uuid in gear_items])
+
+    def save(self):
+        self._cache.save()
+
+    def _build(self, user_profile_pk):
+        """Fetch the gear list and the activities of every gear item."""
+        log.debug("Gear list URL: " + gceaccess.URL_GEAR_DETAIL + "userProfilePk=" + str(user_profile_pk))
+        gear = json.loads(gceaccess.http_req(gceaccess.URL_GEAR_DETAIL + "userProfilePk=" + str(user_profile_pk)))
+        self.requests += 1
+        activities = {}
+        for item in gear:
+            start = 0
+            while True:
+                search_parms = {"start": start, "limit": gceaccess.LIMIT_MAXIMUM}
+                url = (gceaccess.URL_GEAR_ACTIVITIES + item["uuid"] + "/gear?"
+                       + urllib.parse.urlencode(search_parms))
+                log.debug("Gear activities URL: " + url)
+                page = json.loads(gceaccess.http_req(url))
+                self.requests += 1
+                for a in page:
+                    activities.setdefault(str(a["activityId"]), []).append(item["uuid"])
+                if len(page) < gceaccess.LIMIT_MAXIMUM:
+                    break
+                start += gceaccess.LIMIT_MAXIMUM
+        log.info("resolved " + str(len(gear)) + " gear items for " + str(len(activities)) + " activities")
+        self._gear = gear
+        self._activities = activities
+        self._built = True
+        self._cache.put("gear", gear)
+        self._cache.put("activities", activities)
@@ -0,0 +1,123 @@
+"""
+persistent sync index for the garmin connect export
+
+A SQLite file in the export directory records, per activity, which artifacts were fetched
+(the data file in each format and the summary, app info, details and gear JSON) with the
+file name, size and time. Deciding whether an activity is complete is one indexed lookup
+instead of a handful of isfile probes, and an activity that misses a single artifact can
+fetch just that one. The index records what was fetched: files removed later, e.g. with
+--delete .json, are not fetched again.
+
+"""
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from os.path import isfile, join
+
+log = logging.getLogger(__name__)
+
+INDEX_FILENAME = ".sync_index.sqlite"
+
+SUMMARY = "summary"
+APP_INFO = "app_info"
+DETAIL = "detail"
+GEAR = "gear"
+JSON_ARTIFACTS = (SUMMARY, APP_INFO, DETAIL, GEAR)
+# the file name of a JSON artifact is the activity id followed by this
+JSON_SUFFIXES = {
+    SUMMARY: "_activity_summary.json",
+    APP_INFO: "_app_info.json",
+    DETAIL: "_activity_detail.json",
+    GEAR: "_gear_detail.json",
+}
+
+# file name patterns written by the exporter; data files of format 'original' are the ZIP
+# or whatever was extracted from it
+_FILE_PATTERN = re.compile(
+    r"^(\d+)(_activity\.gpx|_activity\.tcx|_activity\.zip|_ACTIVITY\.fit|\.fit|\.tcx|\.gpx"
+    r"|_activity_summary\.json|_app_info\.json|_activity_detail\.json|_gear_detail\.json)$"
+)
+_SUFFIX_ARTIFACT = {
+    "_activity.gpx": "gpx",
+    "_activity.tcx": "tcx",
+    "_activity.zip": "original",
+    "_ACTIVITY.fit": "original",
+    ".fit": "original",
+    ".tcx": "original",
+    ".gpx": "original",
+    "_activity_summary.json": SUMMARY,
+    "_app_info.json": APP_INFO,
+    "_activity_detail.json": DETAIL,
+    "_gear_detail.json": GEAR,
+}
+
+
+class SyncIndex:
+    def __init__(self, directory, filename=INDEX_FILENAME):
+        """
+        Open (or create) the index of the export directory. A new index is seeded with one
+        listing of the directory, so exports made without the index are not fetched again.
+        """
+        self.directory = directory
+        path = join(directory, filename)
+        created = not isfile(path)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS artifacts ("
+            " activity_id INTEGER NOT NULL,"
+            " artifact TEXT NOT NULL,"
+            " filename TEXT,"
+            " size INTEGER,"
+            " mtime REAL,"
+            " fetched REAL,"
+            " PRIMARY KEY (activity_id, artifact))"
+        )
+        self._db.commit()
+        if created:
+            self.seed()
+
+    def seed(self):
+        """Record the artifacts already in the export directory."""
+        log.debug("seeding the sync index from " + self.directory)
+        rows = []
+        for entry in os.scandir(self.directory):
+            match = _FILE_PATTERN.match(entry.name)
+            if not match or not entry.is_file():
+                continue
+            stat = entry.stat()
+            rows.append((int(match.group(1)), _SUFFIX_ARTIFACT[match.group(2)], entry.name,
+                         stat.st_size, stat.st_mtime, stat.st_mtime))
+        with self._lock:
+            self._db.executemany("INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self._db.commit()
+        log.info("sync index seeded with " + str(len(rows)) + " files")
+
+    def fetched(self, activity_id):
+        """Return the set of artifacts fetched for the activity."""
+        with self._lock:
+            cursor = self._db.execute("SELECT artifact FROM artifacts WHERE activity_id = ?", (int(activity_id),))
+            return {row[0] for row in cursor}
+
+    def record(self, activity_id, artifact, filename):
+        """Remember that the artifact of the activity was written to filename."""
+        try:
+            stat = os.stat(filename)
+            size, mtime = stat.st_size, stat.st_mtime
+        except OSError:
+            size, mtime = None, None
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?, ?, ?, ?)",
+                (int(activity_id), artifact, os.path.basename(filename), size, mtime, time.time()),
+            )
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,201 @@
+"""
+timing of the garmin connect export
+
+Every request is counted per endpoint (the URL_* constant of gceaccess it was built from)
+with its bytes, outcome and latency, and every stage that works on the file system
+(unzipping, writing the csv, archiving, ...) with its time. The histograms have fixed
+buckets, so they can be written in the Prometheus text format as they are. At the end of
+a run the numbers go into a JSON report and, if asked for, a file for the textfile
+collector of the Prometheus node exporter.
+
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# upper bounds of the latency buckets in seconds, the last bucket takes the rest
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.maximum = max(self.maximum, seconds)
+        for number, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[number] += 1
+                return
+        self.buckets[-1] += 1
+
+    def quantile(self, q):
+        """The upper bound of the bucket the q quantile falls into, the maximum for the last bucket."""
+        rank = q * self.count
+        seen = 0
+        for number, count in enumerate(self.buckets[:-1]):
+            seen += count
+            if seen >= rank and count:
+                return min(BUCKETS[number], self.maximum)
+        return self.maximum
+
+    def asdict(self):
+        return {
+            "count": self.count,
+            "seconds": round(self.total, 3),
+            "average": round(self.total / self.count, 3) if self.count else 0.0,
+            "p50": round(self.quantile(0.5), 3),
+            "p95": round(self.quantile(0.95), 3),
+            "max": round(self.maximum, 3),
+            "buckets": {("+Inf" if number == len(BUCKETS) else str(BUCKETS[number])): count
+                        for number, count in enumerate(self.buckets)},
+        }
+
+
+class Endpoint:
+    def __init__(self):
+        self.latency = Histogram()
+        self.bytes = 0
+        # outcome of the attempts: HTTP status, or "error" for a timeout or network error
+        self.outcomes = {}
+
+
+class _Stage:
+    """Context manager that adds the time spent in a with block to a stage."""
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+        self.started = 0.0
+
+    def __enter__(self):
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.addstage(self.name, time.monotonic() - self.started)
+        return False
+
+
+class Metrics:
+    """The counters of one run; the workers and the event loop thread report into it."""
+
+    def __init__(self):
+        self.started = time.time()
+        self._clock = time.monotonic()
+        self._endpoints = {}
+        self._stages = {}
+        self._lock = threading.Lock()
+
+    def request(self, endpoint, seconds, size, status):
+        """
+        Count one attempt of a request.
+        :param endpoint: the name of the endpoint, see gceaccess.endpoint()
+        :param size: bytes of the response body
+        :param status: the HTTP status, None for a timeout or network error
+        """
+        outcome = "error" if status is None else str(status)
+        with self._lock:
+            counters = self._endpoints.get(endpoint)
+            if counters is None:
+                counters = self._endpoints[endpoint] = Endpoint()
+            counters.latency.observe(seconds)
+            counters.bytes += size
+            counters.outcomes[outcome] = counters.outcomes.get(outcome, 0) + 1
+
+    def stage(self, name):
+        """with metrics.stage('archive'): ... adds the time of the block to the stage."""
+        return _Stage(self, name)
+
+    def addstage(self, name, seconds):
+        with self._lock:
+            histogram = self._stages.get(name)
+            if histogram is None:
+                histogram = self._stages[name] = Histogram()
+            histogram.observe(seconds)
+
+    def report(self, extra=None):
+        """
+        The counters as a dict for the JSON report.
+        :param extra: more entries for the top level, e.g. the totals of the run
+        """
+        with self._lock:
+            report = {
+                "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+                "seconds": round(time.monotonic() - self._clock, 3),
+                "endpoints": {
+                    name: dict(counters.latency.asdict(), bytes=counters.bytes, outcomes=dict(counters.outcomes))
+                    for name, counters in sorted(self._endpoints.items())
+                },
+                "stages": {name: histogram.asdict() for name, histogram in sorted(self._stages.items())},
+            }
+        if extra:
+            report.update(extra)
+        return report
+
+    def writejson(self, filename, extra=None):
+        _replace(filename, json.dumps(self.report(extra), indent=2) + "\n")
+        log.info("run report written to " + filename)
+
+    def writeprometheus(self, filename, extra=None):
+        """
+        Write the counters in the Prometheus text format, for the textfile collector of the
+        node exporter.
+        :param extra: more gauges, name -> number; they are written as gcexport_<name>
+        """
+        lines = []
+        with self._lock:
+            endpoints = sorted(self._endpoints.items())
+            stages = sorted(self._stages.items())
+            lines += _histogram("gcexport_request_seconds", "Latency of the requests to Garmin Connect.",
+                                "endpoint", [(name, counters.latency) for name, counters in endpoints])
+            lines += ["# HELP gcexport_response_bytes_total Bytes received from Garmin Connect.",
+                      "# TYPE gcexport_response_bytes_total counter"]
+            lines += ['gcexport_response_bytes_total{endpoint="' + name + '"} ' + str(counters.bytes)
+                      for name, counters in endpoints]
+            lines += ["# HELP gcexport_requests_total Requests to Garmin Connect by outcome.",
+                      "# TYPE gcexport_requests_total counter"]
+            for name, counters in endpoints:
+                for outcome, count in sorted(counters.outcomes.items()):
+                    lines.append('gcexport_requests_total{endpoint="' + name + '",outcome="' + outcome + '"} '
+                                 + str(count))
+            lines += _histogram("gcexport_stage_seconds", "Time spent in the stages of the export.",
+                                "stage", stages)
+        lines += ["# HELP gcexport_run_seconds Duration of the run.", "# TYPE gcexport_run_seconds gauge",
+                  "gcexport_run_seconds " + "{0:.3f}".format(time.monotonic() - self._clock),
+                  "# HELP gcexport_last_run_timestamp_seconds Start of the run.",
+                  "# TYPE gcexport_last_run_timestamp_seconds gauge",
+                  "gcexport_last_run_timestamp_seconds " + str(int(self.started))]
+        for name, value in sorted((extra or {}).items()):
+            lines += ["# TYPE gcexport_" + name + " gauge", "gcexport_" + name + " " + str(value)]
+        _replace(filename, "\n".join(lines) + "\n")
+        log.info("Prometheus metrics written to " + filename)
+
+
+def _histogram(metric, help_text, label, histograms):
+    lines = ["# HELP " + metric + " " + help_text, "# TYPE " + metric + " histogram"]
+    for name, histogram in histograms:
+        cumulative = 0
+        for number, count in enumerate(histogram.buckets):
+            cumulative += count
+            bound = "+Inf" if number == len(BUCKETS) else str(BUCKETS[number])
+            lines.append(metric + "_bucket{" + label + '="' + name + '",le="' + bound + '"} ' + str(cumulative))
+        lines.append(metric + "_sum{" + label + '="' + name + '"} ' + "{0:.6f}".format(histogram.total))
+        lines.append(metric + "_count{" + label + '="' + name + '"} ' + str(histogram.count))
+    return lines
+
+
+def _replace(filename, text):
+    # the node exporter may read the file at any time, it must never see half of it
+    with open(filename + ".tmp", "w", encoding="utf-8") as report_file:
+        report_file.write(text)
+    os.replace(filename + ".tmp", filename)
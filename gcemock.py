@@ -0,0 +1,326 @@
+#!/usr/bin/python3
+"""
+local stand-in for Garmin Connect, for trying out and benchmarking the export
+
+It answers every request of gceaccess (login and ticket, profile, user stats, activity
+list, summary and details, the GPX, TCX and original downloads, device info and gear)
+with synthetic data of a configurable size, after a configurable latency, and fails a
+configurable share of the requests with 503 or cuts off downloads halfway. The data of an
+activity only depends on its id, so every run sees the same account.
+
+    python3 gcemock.py --port 8765 --activities 500 --latency 50
+    python3 gcexport3.py --base-url http://127.0.0.1:8765 --username x --password x -c all
+
+"""
+import argparse
+import io
+import json
+import logging
+import random
+import re
+import socket
+import threading
+import time
+import zipfile
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+log = logging.getLogger(__name__)
+
+DISPLAY_NAME = "mockuser"
+USER_PROFILE_PK = 4242
+DEVICES = ((3310000001, "Edge 530", "9.10"), (3310000002, "Forerunner 945", "12.00"), (3310000003, "fēnix 6", "20.00"))
+GEAR = ({"uuid": "a1b2c3", "customMakeModel": "Canyon Endurace"}, {"uuid": "d4e5f6", "customMakeModel": "Pegasus 38"})
+TYPES = ("cycling", "running", "walking", "lap_swimming")
+FIRST_ACTIVITY = 5000000000
+FIRST_START = datetime(2018, 1, 1, 7, 30)
+
+
+class MockAccount:
+    """The synthetic activities of the stand-in and the options of its answers."""
+
+    def __init__(self, activities=100, points=500, fit_size=50000, latency=0.0, jitter=0.0, error_rate=0.0,
+                 truncate_rate=0.0, seed=1):
+        """
+        :param activities: number of activities of the account
+        :param points: track points per GPX/TCX file, samples of the activity details
+        :param fit_size: bytes of the FIT file in an original download
+        :param latency: seconds before every answer, plus up to jitter seconds
+        :param error_rate: share of the requests (all but the login) answered with 503
+        :param truncate_rate: share of the downloads that are cut off after half of the body
+        """
+        self.activities = activities
+        self.points = points
+        self.fit_size = fit_size
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.truncate_rate = truncate_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.requests = 0
+
+    def chance(self, rate):
+        if rate <= 0:
+            return False
+        with self._lock:
+            return self._random.random() < rate
+
+    def delay(self):
+        if self.latency or self.jitter:
+            with self._lock:
+                extra = self._random.uniform(0, self.jitter)
+            time.sleep(self.latency + extra)
+
+    def activityid(self, number):
+        """The id of the activity number (0 is the newest)."""
+        return FIRST_ACTIVITY + self.activities - number
+
+    def listentry(self, number):
+        activity_id = self.activityid(number)
+        activity_type = TYPES[activity_id % len(TYPES)]
+        start = FIRST_START + timedelta(hours=7 * (self.activities - number))
+        return {
+            "activityId": activity_id,
+            "activityName": activity_type.title() + " " + str(activity_id),
+            "description": None,
+            "startTimeLocal": start.strftime("%Y-%m-%d %H:%M:%S"),
+            "activityType": {"typeKey": activity_type},
+            "eventType": {"typeKey": "uncategorized"},
+            "ownerId": USER_PROFILE_PK,
+        }
+
+    def search(self, query):
+        """The list entries that match the startDate, endDate and activityType of a search."""
+        start_date = query.get("startDate", [""])[0]
+        end_date = query.get("endDate", ["9999"])[0]
+        activity_type = query.get("activityType", [None])[0]
+        entries = []
+        for number in range(self.activities):
+            entry = self.listentry(number)
+            if start_date <= entry["startTimeLocal"][:10] <= end_date \
+                    and activity_type in (None, entry["activityType"]["typeKey"]):
+                entries.append(entry)
+        return entries
+
+    def summary(self, activity_id):
+        number = FIRST_ACTIVITY + self.activities - activity_id
+        start = FIRST_START + timedelta(hours=7 * (self.activities - number))
+        duration = 1800.0 + activity_id % 7200
+        distance = duration * (3 + activity_id % 5)
+        return {
+            "activityId": activity_id,
+            "activityName": self.listentry(number)["activityName"],
+            "userProfileId": USER_PROFILE_PK,
+            "activityTypeDTO": {"typeKey": TYPES[activity_id % len(TYPES)]},
+            "eventTypeDTO": {"typeKey": "uncategorized"},
+            "timeZoneUnitDTO": {"timeZone": "Europe/Berlin"},
+            "metadataDTO": {"deviceApplicationInstallationId": DEVICES[activity_id % len(DEVICES)][0]},
+            "summaryDTO": {
+                "startTimeLocal": start.strftime("%Y-%m-%dT%H:%M:%S.0"),
+                "startTimeGMT": (start - timedelta(hours=1)).strftime("%Y-%m-%dT%H:%M:%S.0"),
+                "elapsedDuration": duration,
+                "movingDuration": duration * 0.9,
+                "distance": distance,
+                "averageSpeed": distance / duration,
+                "averageMovingSpeed": distance / duration / 0.9,
+                "maxSpeed": distance / duration * 1.8,
+                "elevationGain": float(activity_id % 900),
+                "elevationLoss": float(activity_id % 880),
+                "minElevation": 420.0,
+                "maxElevation": 420.0 + activity_id % 900,
+                "minHR": 80,
+                "maxHR": 150 + activity_id % 40,
+                "averageHR": 120 + activity_id % 30,
+                "calories": duration / 3,
+                "startLatitude": 48.1,
+                "startLongitude": 11.5,
+                "endLatitude": 48.1,
+                "endLongitude": 11.6,
+            },
+        }
+
+    def details(self, activity_id):
+        return {
+            "activityId": activity_id,
+            "measurementCount": 4,
+            "metricsCount": self.points,
+            "metricDescriptors": [{"metricsIndex": i, "key": key} for i, key in
+                                  enumerate(("directTimestamp", "directLatitude", "directLongitude", "directHeartRate"))],
+            "activityDetailMetrics": [{"metrics": [1514788200000 + i * 1000, 48.1 + i / 1e5, 11.5 + i / 1e5, 120 + i % 30]}
+                                      for i in range(self.points)],
+        }
+
+    def gpx(self, activity_id):
+        points = "".join('<trkpt lat="{0:.6f}" lon="{1:.6f}"><ele>{2}</ele><time>2018-01-01T07:{3:02d}:{4:02d}Z</time>'
+                         '</trkpt>'.format(48.1 + i / 1e5, 11.5 + i / 1e5, 420 + i % 50, i // 60 % 60, i % 60)
+                         for i in range(self.points))
+        return ('<?xml version="1.0" encoding="UTF-8"?>\n<gpx version="1.1" creator="gcemock"'
+                ' xmlns="http://www.topografix.com/GPX/1/1"><trk><name>' + str(activity_id) + '</name><trkseg>'
+                + points + '</trkseg></trk></gpx>\n').encode()
+
+    def tcx(self, activity_id):
+        points = "".join('<Trackpoint><Position><LatitudeDegrees>{0:.6f}</LatitudeDegrees><LongitudeDegrees>{1:.6f}'
+                         '</LongitudeDegrees></Position></Trackpoint>'.format(48.1 + i / 1e5, 11.5 + i / 1e5)
+                         for i in range(self.points))
+        return ('<?xml version="1.0" encoding="UTF-8"?>\n<TrainingCenterDatabase><Activities><Activity><Id>'
+                + str(activity_id) + '</Id><Lap><Track>' + points
+                + '</Track></Lap></Activity></Activities></TrainingCenterDatabase>\n').encode()
+
+    def original(self, activity_id):
+        fit = random.Random(activity_id).randbytes(self.fit_size)
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as zip_file:
+            zip_file.writestr(str(activity_id) + "_ACTIVITY.fit", fit)
+        return buffer.getvalue()
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    account = None
+
+    def log_message(self, message_format, *args):
+        log.debug(message_format, *args)
+
+    def answer(self, code, body=b"", content_type="application/json", headers=None, download=False):
+        if isinstance(body, str):
+            body = body.encode()
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode()
+        if download and code == 200 and self.headers.get("Range"):
+            start = int(re.match(r"bytes=(\d+)-", self.headers["Range"]).group(1))
+            if start >= len(body):
+                code, body = 416, b""
+            else:
+                headers = {"Content-Range": "bytes " + str(start) + "-" + str(len(body) - 1) + "/" + str(len(body))}
+                code, body = 206, body[start:]
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if download and code in (200, 206) and self.account.chance(self.account.truncate_rate):
+            # the connection breaks off in the middle of the body
+            self.wfile.write(body[:len(body) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            self.connection.shutdown(socket.SHUT_RDWR)
+            return
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.account.delay()
+        if urlsplit(self.path).path == "/sso/signin":
+            return self.answer(200, 'var response_url = "https://connect.garmin.com/modern/?ticket=ST-0001-mock";',
+                               "text/html", {"Set-Cookie": "CASTGC=mock; Path=/"})
+        self.answer(404, "not found", "text/plain")
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        path = parts.path
+        query = parse_qs(parts.query)
+        account = self.account
+        with account._lock:
+            account.requests += 1
+        account.delay()
+        if path == "/sso/signin":
+            return self.answer(200, "<html>sign in</html>", "text/html")
+        if path == "/modern/activities":
+            return self.answer(200, "<html>activities</html>", "text/html", {"Set-Cookie": "SESSIONID=mock; Path=/"})
+        if account.chance(account.error_rate):
+            return self.answer(503, "busy", "text/plain", {"Retry-After": "0"})
+        if path == "/modern/profile":
+            return self.answer(200, '<script>window.VIEWER_SOCIAL_PROFILE = JSON.parse("{\\"displayName\\":\\"'
+                               + DISPLAY_NAME + '\\"}");</script>', "text/html")
+        if path == "/modern/proxy/userstats-service/statistics/" + DISPLAY_NAME:
+            return self.answer(200, {"userMetrics": [{"totalActivities": account.activities}]})
+        if path == "/modern/proxy/activitylist-service/activities/search/activities":
+            start = int(query.get("start", ["0"])[0])
+            limit = int(query.get("limit", ["20"])[0])
+            return self.answer(200, account.search(query)[start:start + limit])
+        match = re.match(r"/modern/proxy/activity-service/activity/(\d+)(/details)?$", path)
+        if match:
+            activity_id = int(match.group(1))
+            if match.group(2):
+                return self.answer(200, account.details(activity_id))
+            return self.answer(200, account.summary(activity_id))
+        match = re.match(r"/modern/proxy/download-service/export/(gpx|tcx)/activity/(\d+)$", path)
+        if match:
+            activity_id = int(match.group(2))
+            if match.group(1) == "gpx":
+                return self.answer(200, account.gpx(activity_id), "application/gpx+xml", download=True)
+            return self.answer(200, account.tcx(activity_id), "application/vnd.garmin.tcx+xml", download=True)
+        match = re.match(r"/(modern/)?proxy/download-service/files/activity/(\d+)$", path)
+        if match:
+            return self.answer(200, account.original(int(match.group(2))), "application/x-zip-compressed",
+                               download=True)
+        match = re.match(r"/modern/proxy/device-service/deviceservice/app-info/(\d+)$", path)
+        if match:
+            for installation_id, product, version in DEVICES:
+                if installation_id == int(match.group(1)):
+                    return self.answer(200, {"productDisplayName": product, "versionString": version})
+            return self.answer(200, {})
+        if path == "/modern/proxy/gear-service/gear/filterGear":
+            if "activityId" in query:
+                activity_id = int(query["activityId"][0])
+                return self.answer(200, [GEAR[activity_id % 2]] if activity_id % 3 else [])
+            return self.answer(200, [dict(gear, userProfilePk=USER_PROFILE_PK) for gear in GEAR])
+        match = re.match(r"/modern/proxy/activitylist-service/activities/(\w+)/gear$", path)
+        if match:
+            start = int(query.get("start", ["0"])[0])
+            limit = int(query.get("limit", ["20"])[0])
+            uuids = [gear["uuid"] for gear in GEAR]
+            number = uuids.index(match.group(1)) if match.group(1) in uuids else -1
+            # the same gear as filterGear answers for the activity
+            entries = [account.listentry(n) for n in range(account.activities)
+                       if account.activityid(n) % 3 and account.activityid(n) % 2 == number]
+            return self.answer(200, entries[start:start + limit])
+        self.answer(404, "not found", "text/plain")
+
+
+def serve(account, port=0, host="127.0.0.1"):
+    """
+    Start the stand-in in a thread.
+    :param port: 0 for any free port
+    :return: the server, its port is server.server_address[1]; server.shutdown() stops it
+    """
+    handler = type("Handler", (MockHandler,), {"account": account})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="local stand-in for Garmin Connect")
+    parser.add_argument("--port", type=int, default=8765, help="0 for any free port (default: 8765)")
+    parser.add_argument("--activities", type=int, default=100, help="activities of the account (default: 100)")
+    parser.add_argument("--points", type=int, default=500, help="track points per activity (default: 500)")
+    parser.add_argument("--fit-size", type=int, default=50000, help="bytes per FIT file (default: 50000)")
+    parser.add_argument("--latency", type=float, default=0, metavar="MS", help="delay of every answer (default: 0)")
+    parser.add_argument("--jitter", type=float, default=0, metavar="MS",
+                        help="random extra delay of up to this much (default: 0)")
+    parser.add_argument("--error-rate", type=float, default=0,
+                        help="share of the requests answered with 503, e.g. 0.05 (default: 0)")
+    parser.add_argument("--truncate-rate", type=float, default=0,
+                        help="share of the downloads cut off halfway (default: 0)")
+    parser.add_argument("--debug", help="log every request", action="store_true")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
+    account = MockAccount(args.activities, args.points, args.fit_size, args.latency / 1000, args.jitter / 1000,
+                          args.error_rate, args.truncate_rate)
+    server = serve(account, args.port)
+    # the first line tells a harness that started this where to connect
+    print("listening on http://127.0.0.1:" + str(server.server_address[1]), flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+"""
+pack storage for the JSON artifacts of the garmin connect export
+
+Instead of four or five small JSON files per activity, every artifact is compressed into a
+record that is appended to one pack file in the export directory. A SQLite index next to
+it maps the file name the artifact would have had (e.g. 1234_activity_summary.json) to the
+position of its record, with the activity id and artifact type in their own columns.
+
+A record is a header (magic, codec, length of the name and of the data), the name and the
+compressed data, so the index can always be rebuilt from the pack alone. Writes are
+buffered; flush() makes them durable and visible in the index. An index that lags behind
+the pack after a crash is completed from the records after its last one when the pack is
+opened again, and a record that was cut off is dropped.
+
+"""
+import gzip
+import logging
+import os
+import re
+import sqlite3
+import struct
+import threading
+import zlib
+from os.path import join
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+log = logging.getLogger(__name__)
+
+PACK_FILENAME = "artifacts.pack"
+INDEX_FILENAME = "artifacts.pack.sqlite"
+
+GZIP = 1
+ZSTD = 2
+CODECS = {"gzip": GZIP, "zstd": ZSTD}
+
+_MAGIC = b"GCEP"
+_HEADER = struct.Struct(">4sBHI")
+# activity artifacts, named like the loose files
+_NAME_PATTERN = re.compile(r"^(\d+)_(activity_summary|app_info|activity_detail|gear_detail)\.json$")
+# these files were appended to with every run, all of their records belong to them
+APPENDED = ("activity_list.json", "userstats.json")
+
+
+class PackStore:
+    def __init__(self, directory, compression="gzip", level=6, readonly=False):
+        """
+        Open (or create) the pack of the export directory.
+        :param compression: 'gzip', or 'zstd' if the zstandard package is installed
+        :param readonly: only get() records, e.g. in the worker processes of --rebuild-csv
+        """
+        if compression == "zstd" and zstandard is None:
+            raise Exception("zstd compression needs the zstandard package (pip install zstandard).")
+        self.codec = CODECS[compression]
+        self.level = level
+        self._path = join(directory, PACK_FILENAME)
+        self._lock = threading.Lock()
+        self._pending = []
+        self._decompressor = zstandard.ZstdDecompressor() if zstandard else None
+        self._db = sqlite3.connect(join(directory, INDEX_FILENAME), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS records ("
+            " offset INTEGER PRIMARY KEY,"
+            " name TEXT NOT NULL,"
+            " activity_id INTEGER,"
+            " artifact TEXT,"
+            " codec INTEGER NOT NULL,"
+            " length INTEGER NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS records_name ON records (name, offset)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS records_activity ON records (activity_id, artifact)")
+        self._db.commit()
+        if readonly:
+            self._writer = None
+            self._reader = open(self._path, "rb")
+            return
+        self._writer = open(self._path, "ab")
+        self._reader = open(self._path, "rb")
+        self._end = self._writer.seek(0, os.SEEK_END)
+        self._recover()
+
+    def _recover(self):
+        """Index the records written after the last indexed one (if the run before crashed)."""
+        row = self._db.execute("SELECT offset, length, name FROM records ORDER BY offset DESC LIMIT 1").fetchone()
+        position = row[0] + _HEADER.size + len(row[2].encode("utf-8")) + row[1] if row else 0
+        recovered = 0
+        while position < self._end:
+            self._reader.seek(position)
+            header = self._reader.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                break
+            magic, codec, name_length, length = _HEADER.unpack(header)
+            name = self._reader.read(name_length).decode("utf-8")
+            if magic != _MAGIC or position + _HEADER.size + name_length + length > self._end:
+                break
+            self._index(position, name, codec, length)
+            position += _HEADER.size + name_length + length
+            recovered += 1
+        if position < self._end:
+            # a record cut off by a crash, the next record takes its place
+            log.warning("pack " + self._path + " ends with an incomplete record at " + str(position))
+            self._writer.truncate(position)
+            self._end = position
+        if recovered:
+            self._db.commit()
+            log.info("indexed " + str(recovered) + " pack records that were not in the index")
+
+    def _index(self, offset, name, codec, length):
+        match = _NAME_PATTERN.match(name)
+        activity_id, artifact = (int(match.group(1)), match.group(2)) if match else (None, None)
+        self._db.execute("INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?, ?)",
+                         (offset, name, activity_id, artifact, codec, length))
+
+    def put(self, name, text):
+        """
+        Append an artifact. It replaces an earlier record of the name, except for the files
+        in APPENDED, which consist of all their records.
+        """
+        data = text.encode("utf-8")
+        if self.codec == ZSTD:
+            # a compressor is not to be used by two threads at once, the workers put in parallel
+            data = zstandard.ZstdCompressor(level=self.level).compress(data)
+        else:
+            data = gzip.compress(data, self.level)
+        self._append(name, data)
+
+    def putfile(self, name, source):
+        """
+        Append an artifact that is read from the binary file source piece by piece, so a
+        large one (the details of a long activity) is never in memory uncompressed.
+        """
+        if self.codec == ZSTD:
+            compressor = zstandard.ZstdCompressor(level=self.level).compressobj()
+        else:
+            # a gzip stream like gzip.compress writes
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+        parts = [compressor.compress(chunk) for chunk in iter(lambda: source.read(65536), b"")]
+        parts.append(compressor.flush())
+        self._append(name, b"".join(parts))
+
+    def _append(self, name, data):
+        name_bytes = name.encode("utf-8")
+        with self._lock:
+            offset = self._end
+            self._writer.write(_HEADER.pack(_MAGIC, self.codec, len(name_bytes), len(data)) + name_bytes + data)
+            self._end += _HEADER.size + len(name_bytes) + len(data)
+            self._pending.append((offset, name, self.codec, len(data)))
+
+    def flush(self):
+        """Write the buffered records to the pack and add them to the index."""
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if not self._pending:
+            return
+        self._writer.flush()
+        os.fsync(self._writer.fileno())
+        for offset, name, codec, length in self._pending:
+            self._index(offset, name, codec, length)
+        self._db.commit()
+        self._pending = []
+
+    def _read(self, offset, name, codec, length):
+        self._reader.seek(offset + _HEADER.size + len(name.encode("utf-8")))
+        data = self._reader.read(length)
+        if codec == ZSTD:
+            if self._decompressor is None:
+                raise Exception("The pack has zstd records, reading them needs the zstandard package.")
+            # a record of putfile has no content size in its frame header, decompress() needs one
+            data = self._decompressor.decompressobj().decompress(data)
+        else:
+            data = gzip.decompress(data)
+        return data.decode("utf-8")
+
+    def get(self, name):
+        """The text of the artifact, None if the pack has no record of it."""
+        with self._lock:
+            self._flush()
+            if name in APPENDED:
+                rows = self._db.execute("SELECT offset, name, codec, length FROM records WHERE name = ?"
+                                        " ORDER BY offset", (name,)).fetchall()
+                return "".join(self._read(*row) for row in rows) if rows else None
+            row = self._db.execute("SELECT offset, name, codec, length FROM records WHERE name = ?"
+                                   " ORDER BY offset DESC LIMIT 1", (name,)).fetchone()
+            return self._read(*row) if row else None
+
+    def has(self, name):
+        """True if the pack has a record of the artifact, without reading it."""
+        with self._lock:
+            self._flush()
+            return self._db.execute("SELECT 1 FROM records WHERE name = ? LIMIT 1", (name,)).fetchone() is not None
+
+    def activities(self):
+        """The ids of the activities that have a summary in the pack."""
+        with self._lock:
+            self._flush()
+            cursor = self._db.execute("SELECT DISTINCT activity_id FROM records WHERE artifact = 'activity_summary'")
+            return [str(row[0]) for row in cursor]
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            if self._writer:
+                self._writer.close()
+            self._reader.close()
+            self._db.close()
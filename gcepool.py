@@ -0,0 +1,235 @@
+"""
+keep-alive connection pool for the garmin connect export
+
+urllib opens a new TCP (and TLS) connection for every request. The pool keeps the
+http.client connections per host open and hands them out again, one request at a time
+per connection, so it can be shared by the worker threads. Cookies are kept in the same
+http.cookiejar as the urllib opener, redirects are followed like urllib does. The helpers
+that prepare a request and follow its redirects are shared with gceasync.
+
+"""
+import http.client
+import io
+import logging
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+
+log = logging.getLogger(__name__)
+
+MAX_REDIRECTS = 10
+
+
+class _CookieResponse:
+    """Minimal response object for http.cookiejar.CookieJar.extract_cookies."""
+
+    def __init__(self, headers):
+        self._headers = headers
+
+    def info(self):
+        return self._headers
+
+
+def buildrequest(url, post, headers, user_agent, cookie_jar):
+    """The urllib.request.Request of url with the User-Agent, the extra headers and the cookies of cookie_jar."""
+    request = urllib.request.Request(url, data=post)
+    request.add_header("User-Agent", user_agent)
+    if headers:
+        for header_key, header_value in headers.items():
+            request.add_header(header_key, header_value)
+    cookie_jar.add_cookie_header(request)
+    return request
+
+
+def storecookies(cookie_jar, response_headers, request):
+    """Keep the cookies a response to request sets in cookie_jar."""
+    cookie_jar.extract_cookies(_CookieResponse(response_headers), request)
+
+
+def redirecttarget(url, status, response_headers, post):
+    """
+    Where a redirect of the request to url goes.
+    :return: the new url and the form data to send there, None if the response is no redirect
+    """
+    location = response_headers.get("Location")
+    if status not in (301, 302, 303, 307, 308) or not location:
+        return None
+    # like urllib, a redirected POST turns into a GET
+    return urllib.parse.urljoin(url, location), None if status in (301, 302, 303) else post
+
+
+def requesttarget(request):
+    """The connection key (scheme, host, port), the path with the query and the headers of a request."""
+    parts = urllib.parse.urlsplit(request.full_url)
+    port = parts.port or (443 if parts.scheme == "https" else 80)
+    path = parts.path or "/"
+    if parts.query:
+        path += "?" + parts.query
+    request_headers = dict(request.header_items())
+    if request.data is not None:
+        request_headers.setdefault("Content-Type", "application/x-www-form-urlencoded")
+    return (parts.scheme, parts.hostname, port), path, request_headers
+
+
+class PooledResponse:
+    """
+    An http.client.HTTPResponse that gives its connection back to the pool once the body
+    is read to the end; close() before that drops the connection.
+    """
+
+    def __init__(self, pool, key, connection, response):
+        self._pool = pool
+        self._key = key
+        self._connection = connection
+        self._response = response
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.msg
+
+    def getcode(self):
+        return self.status
+
+    def getheader(self, name, default=None):
+        return self._response.getheader(name, default)
+
+    def read(self, amt=None):
+        try:
+            data = self._response.read(amt)
+        except BaseException:
+            self.close()
+            raise
+        if self._response.isclosed():
+            self._release()
+        return data
+
+    def _release(self):
+        if self._connection is None:
+            return
+        if self._response.will_close:
+            self._connection.close()
+        else:
+            self._pool._checkin(self._key, self._connection)
+        self._connection = None
+
+    def close(self):
+        if self._connection is None:
+            return
+        if not self._response.isclosed():
+            # the rest of the body is still on the wire, the connection can't be reused
+            self._response.close()
+            self._connection.close()
+            self._connection = None
+        self._release()
+
+
+class ConnectionPool:
+    def __init__(self, cookie_jar, user_agent, per_host=10, connect_timeout=None, read_timeout=None):
+        """
+        :param cookie_jar: the http.cookiejar shared with the urllib opener
+        :param user_agent: User-Agent header sent with every request
+        :param per_host: maximum number of idle connections kept per host
+        :param connect_timeout: seconds to wait for a connection, None waits forever
+        :param read_timeout: seconds to wait for each piece of a response, None waits forever
+        """
+        self.cookie_jar = cookie_jar
+        self.user_agent = user_agent
+        self.per_host = per_host
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.opened = 0
+        self.reused = 0
+        self.requests = 0
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def stats(self):
+        """Connections opened versus requests served, to see whether the pool is working."""
+        with self._lock:
+            return {"opened": self.opened, "reused": self.reused, "requests": self.requests}
+
+    def close(self):
+        with self._lock:
+            for connections in self._idle.values():
+                for connection in connections:
+                    connection.close()
+            self._idle.clear()
+
+    def _checkout(self, key):
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                self.reused += 1
+                return idle.pop(), True
+            self.opened += 1
+        scheme, host, port = key
+        if scheme == "https":
+            connection = http.client.HTTPSConnection(host, port, timeout=self.connect_timeout)
+        else:
+            connection = http.client.HTTPConnection(host, port, timeout=self.connect_timeout)
+        connection.connect()
+        # the connect timeout is over, from now on the read timeout applies
+        connection.sock.settimeout(self.read_timeout)
+        return connection, False
+
+    def _checkin(self, key, connection):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.per_host:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def open(self, url, post=None, headers=None):
+        """
+        Make the request, follow redirects and read the body.
+        :param post: urlencoded form data, sends a POST request
+        :return: status code and body of the final response; 4xx/5xx raise urllib.error.HTTPError
+        """
+        response = self.stream(url, post, headers)
+        return response.status, response.read()
+
+    def stream(self, url, post=None, headers=None):
+        """
+        Make the request and follow redirects, but leave the body of the final response to
+        the caller: read() it to the end or close() it.
+        :return: a PooledResponse; 4xx/5xx raise urllib.error.HTTPError
+        """
+        for _ in range(MAX_REDIRECTS):
+            request = buildrequest(url, post, headers, self.user_agent, self.cookie_jar)
+            response = self._roundtrip(request)
+            storecookies(self.cookie_jar, response.headers, request)
+            redirect = redirecttarget(url, response.status, response.headers, post)
+            if redirect:
+                response.read()
+                url, post = redirect
+                log.debug("redirected to " + url)
+                continue
+            break
+        else:
+            raise urllib.error.HTTPError(url, response.status, "Too many redirects", response.headers, None)
+        if response.status >= 400:
+            raise urllib.error.HTTPError(url, response.status, response.reason, response.headers,
+                                         io.BytesIO(response.read()))
+        return response
+
+    def _roundtrip(self, request):
+        """Send one request on a pooled connection, a GET is retried once if a reused one went stale."""
+        key, path, request_headers = requesttarget(request)
+        for attempt in range(2):
+            connection, reused = self._checkout(key)
+            try:
+                connection.request(request.get_method(), path, request.data, request_headers)
+                response = connection.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionError, http.client.BadStatusLine):
+                connection.close()
+                if reused and attempt == 0 and request.data is None:
+                    log.debug("stale keep-alive connection to " + key[1] + ", reconnecting")
+                    continue
+                raise
+            except BaseException:
+                connection.close()
+                raise
+            with self._lock:
+                self.requests += 1
+            return PooledResponse(self, key, connection, response)
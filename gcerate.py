@@ -0,0 +1,104 @@
+"""
+request rate limiting for the garmin connect export
+
+"""
+import logging
+import threading
+import time
+import urllib.parse
+
+log = logging.getLogger(__name__)
+
+
+class HostRateLimiter:
+    """
+    Token bucket per host. Every request takes one token of the bucket of its host,
+    the buckets refill with 'rate' tokens per second up to 'burst' tokens.
+    A rate of 0 disables the limiter.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = max(1.0, float(burst))
+        self._buckets = {}
+        # host -> [requests, time of the first request]
+        self._sent = {}
+        self._lock = threading.Lock()
+
+    def hostrate(self, host):
+        """The rate the host is limited to right now."""
+        return self.rate
+
+    def reserve(self, url):
+        """Take a token for the host of url and return the seconds to wait before sending."""
+        host = urllib.parse.urlsplit(url).netloc
+        with self._lock:
+            now = time.monotonic()
+            self._sent.setdefault(host, [0, now])[0] += 1
+            rate = self.hostrate(host)
+            if rate <= 0:
+                return 0.0
+            tokens, last = self._buckets.get(host, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * rate)
+            # take the token now, even if it is not there yet; the caller waits off the deficit
+            # outside of the lock, so other hosts are not blocked by this one
+            tokens -= 1
+            self._buckets[host] = (tokens, now)
+        if tokens < 0:
+            delay = -tokens / rate
+            log.debug("rate limit for " + host + ", waiting " + "{0:.3f}".format(delay) + "s")
+            return delay
+        return 0.0
+
+    def wait(self, url):
+        """Block until a request to the host of url may be sent."""
+        delay = self.reserve(url)
+        if delay:
+            time.sleep(delay)
+
+    def feedback(self, url, status):
+        """Report the outcome of a request: the HTTP status, or None for a timeout or network error."""
+        pass
+
+    def observed(self):
+        """The requests per second that were actually sent to each host."""
+        with self._lock:
+            now = time.monotonic()
+            return {host: count / max(now - first, 1.0) for host, (count, first) in self._sent.items()}
+
+
+class AdaptiveRateLimiter(HostRateLimiter):
+    """
+    Token bucket per host whose rate follows AIMD: every healthy response adds
+    'increase' / rate requests per second (so about 'increase' per second of healthy
+    traffic) up to max_rate, a 429, a 5xx or a timeout halves the rate down to min_rate.
+    """
+
+    def __init__(self, rate, max_rate, min_rate=0.2, increase=0.5, burst=1):
+        super().__init__(rate, burst)
+        self.max_rate = max(float(max_rate), self.rate)
+        self.min_rate = min(float(min_rate), self.rate)
+        self.increase = increase
+        self._rates = {}
+
+    def hostrate(self, host):
+        return self._rates.get(host, self.rate)
+
+    def feedback(self, url, status):
+        if self.rate <= 0:
+            return
+        host = urllib.parse.urlsplit(url).netloc
+        with self._lock:
+            rate = self._rates.get(host, self.rate)
+            if status is None or status == 429 or status >= 500:
+                rate = max(self.min_rate, rate / 2)
+                log.debug("backing off " + host + " to " + "{0:.2f}".format(rate) + " requests/s after "
+                          + (str(status) if status else "a timeout"))
+            else:
+                rate = min(self.max_rate, rate + self.increase / rate)
+            self._rates[host] = rate
+
+    def current(self):
+        """The rate each host is limited to now."""
+        with self._lock:
+            return dict(self._rates)
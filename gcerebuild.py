@@ -0,0 +1,152 @@
+"""
+offline rebuild of activities.csv for the garmin connect export
+
+Everything the csv needs is stored next to the data files: the pages of the activity list
+in activity_list.json and the summary, gear, app info and detail JSON of every activity
+(as loose files or in the pack of --storage pack).
+rebuild() reads them back and writes a new activities.csv without a single request to
+Garmin Connect. Parsing the JSON is the bulk of the work, so it is spread over worker
+processes.
+
+"""
+import csv
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from os.path import isdir, isfile, join
+
+import gceaccess
+import gcecolumns
+import gcepack
+import gceutils
+
+log = logging.getLogger(__name__)
+
+SUMMARY_SUFFIX = "_activity_summary.json"
+
+# the row builders of a worker process, compiled once per process by _initworker
+_ROW = None
+_TYPED_ROW = None
+
+
+def readactivitylist(directory):
+    """
+    The entries of activity_list.json by activity id. Every run appends the pages it fetched
+    to the file, so it holds a sequence of JSON arrays; a later entry of an activity wins.
+    """
+    activities = {}
+    text = gceaccess.readartifact(join(directory, "activity_list.json"))
+    if text is None:
+        return activities
+    try:
+        for a in gceutils.jsonelements(text):
+            activities[str(a["activityId"])] = a
+    except ValueError as error:
+        print("Unable to read the rest of activity_list.json. Error: " + str(error))
+    return activities
+
+
+def _initworker(column_keys, typed, pack_directory):
+    global _ROW, _TYPED_ROW
+    if pack_directory:
+        # the connection to the index of the pack can't be shared with the parent process
+        gceaccess.PACK = gcepack.PackStore(pack_directory, readonly=True)
+    _ROW = gcecolumns.rowbuilder(gcecolumns.select(column_keys))
+    _TYPED_ROW = gcecolumns.rowbuilder(gcecolumns.COLUMNS, typed=True) if typed else None
+
+
+def _buildrow(job):
+    """
+    Read the JSON files of one activity and build its csv row (in a worker process).
+    :return: (start time, activity id, csv row, friendly filename, summary database row),
+             None without a summary
+    """
+    directory, stractid, a = job
+    json_summary = gceaccess.readjson(join(directory, stractid + SUMMARY_SUFFIX))
+    if json_summary is None:
+        return None
+    json_gear = gceaccess.readjson(join(directory, stractid + "_gear_detail.json"))
+    json_device = gceaccess.readjson(join(directory, stractid + "_app_info.json"))
+    json_detail = gceaccess.readdetail(join(directory, stractid + "_activity_detail.json"))
+    if a is None:
+        # not in the stored activity list, the summary has most of what the list entry has
+        a = {
+            "activityId": int(stractid),
+            "activityName": json_summary.get("activityName"),
+            "description": json_summary.get("description"),
+            "activityType": json_summary.get("activityTypeDTO"),
+            "eventType": json_summary.get("eventTypeDTO"),
+        }
+    row = _ROW(a, json_summary, json_gear, json_device, json_detail)
+    typed_row = _TYPED_ROW(a, json_summary, json_gear, json_device, json_detail) if _TYPED_ROW else None
+    try:
+        friendly_filename = gceaccess.buildFriendlyFilename(a, json_summary, json_gear, json_device, json_detail, None)
+    except (KeyError, TypeError):
+        friendly_filename = None
+    start = (json_summary.get("summaryDTO") or {}).get("startTimeLocal") or ""
+    return start, stractid, row, friendly_filename, typed_row
+
+
+def rebuild(directory, column_keys=None, workflowdirectory="", workers=None, store=None):
+    """
+    Write activities.csv of an export directory from its JSON files, newest activity first
+    like an export writes it, one row per activity.
+    :param column_keys: the --columns selection
+    :param workflowdirectory: put the FIT files there again under their friendly names,
+                              where they are missing
+    :param workers: number of worker processes, default one per core
+    :param store: an optional gcestore.SummaryStore that gets all activities as well
+    :return: the number of rows written and the number of files put into the workflow directory
+    """
+    if not isdir(directory):
+        raise Exception("There is no export directory " + directory + ".")
+    activities = readactivitylist(directory)
+    jobs = []
+    if gceaccess.PACK:
+        for stractid in gceaccess.PACK.activities():
+            jobs.append((directory, stractid, activities.get(stractid)))
+    else:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.name.endswith(SUMMARY_SUFFIX):
+                    stractid = entry.name[:-len(SUMMARY_SUFFIX)]
+                    jobs.append((directory, stractid, activities.get(stractid)))
+    log.info("rebuilding the csv of " + str(len(jobs)) + " activities")
+    with ProcessPoolExecutor(max_workers=workers, initializer=_initworker,
+                             initargs=(column_keys, store is not None,
+                                       directory if gceaccess.PACK else None)) as executor:
+        results = []
+        for job, result in zip(jobs, executor.map(_buildrow, jobs, chunksize=64)):
+            if result:
+                results.append(result)
+            else:
+                print("Skipping activity " + job[1] + ": its summary can't be read")
+    results.sort(key=lambda result: (result[0], int(result[1]) if result[1].isdigit() else 0), reverse=True)
+
+    csv_filename = join(directory, "activities.csv")
+    # write next to the old csv first, so a failure can't leave half a file
+    with open(csv_filename + ".tmp", "w", encoding="utf-8", newline="") as csv_file:
+        csv_writer = csv.writer(csv_file, lineterminator="\n")
+        csv_writer.writerow(gcecolumns.header(gcecolumns.select(column_keys)))
+        for result in results:
+            csv_writer.writerow(result[2])
+    os.replace(csv_filename + ".tmp", csv_filename)
+    if store:
+        for result in results:
+            store.putrow(result[1], result[4])
+        store.commit()
+
+    copied = 0
+    if workflowdirectory:
+        if not isdir(workflowdirectory):
+            os.mkdir(workflowdirectory)
+        for start, stractid, row, friendly_filename, typed_row in results:
+            destination = join(workflowdirectory, friendly_filename) if friendly_filename else None
+            if not destination or isfile(destination):
+                continue
+            for fit_filename in (stractid + "_ACTIVITY.fit", stractid + ".fit"):
+                if isfile(join(directory, fit_filename)):
+                    gceutils.linkorcopy(join(directory, fit_filename), destination)
+                    copied += 1
+                    break
+    return len(results), copied
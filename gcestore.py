@@ -0,0 +1,70 @@
+"""
+summary database of the garmin connect export
+
+The fields of activities.csv, with native types, in a SQLite table with one row per
+activity: durations in seconds, distances in km, speeds in km/h, begin and end as
+timestamps (sqlite3 with detect_types=sqlite3.PARSE_DECLTYPES reads them back as
+datetime). A row is replaced when the activity is exported again, and the table is
+indexed on the begin time and the activity type, so a query over years of activities
+does not have to read them all.
+
+"""
+import logging
+import sqlite3
+import threading
+
+import gcecolumns
+
+log = logging.getLogger(__name__)
+
+
+class SummaryStore:
+    def __init__(self, filename, columns=None):
+        """
+        Open (or create) the database.
+        :param columns: the gcecolumns.Column of the table, all columns by default
+        """
+        self.columns = list(columns or gcecolumns.COLUMNS)
+        self.row = gcecolumns.rowbuilder(self.columns, typed=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS activities ("
+            " activity_id INTEGER PRIMARY KEY, "
+            + ", ".join(column.key + " " + column.sqltype for column in self.columns)
+            + ")"
+        )
+        # a database of an older version gets the columns added since
+        existing = {row[1] for row in self._db.execute("PRAGMA table_info(activities)")}
+        for column in self.columns:
+            if column.key not in existing:
+                self._db.execute("ALTER TABLE activities ADD COLUMN " + column.key + " " + column.sqltype)
+        self._db.execute("CREATE INDEX IF NOT EXISTS activities_begin ON activities (begin)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS activities_type ON activities (activity_type, begin)")
+        self._db.commit()
+        keys = ["activity_id"] + [column.key for column in self.columns]
+        self._upsert = (
+            "INSERT INTO activities (" + ", ".join(keys) + ") VALUES (" + ", ".join("?" * len(keys)) + ")"
+            " ON CONFLICT (activity_id) DO UPDATE SET "
+            + ", ".join(key + " = excluded." + key for key in keys[1:])
+        )
+
+    def put(self, a, json_summary, json_gear, json_device, json_detail):
+        """Insert the activity, or update it if it is stored already."""
+        self.putrow(a["activityId"], self.row(a, json_summary, json_gear, json_device, json_detail))
+
+    def putrow(self, activity_id, values):
+        """Insert or update an activity with the values of a row built by self.row."""
+        with self._lock:
+            self._db.execute(self._upsert, [int(activity_id)] + values)
+
+    def commit(self):
+        with self._lock:
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.commit()
+            self._db.close()
@@ -1,10 +1,11 @@
+import json
 import logging
 import os
-import time
+import re
 from datetime import timedelta
-from os import mkdir
-from os.path import isdir, sep
-from zipfile import ZipFile
+from xml.etree.ElementTree import iterparse
+from os.path import isfile, sep
+from shutil import copyfile
 
 ####################################################################################################################
 # Updates:
@@ -14,33 +15,6 @@ from zipfile import ZipFile
 log = logging.getLogger(__name__)
 
 
-# Zip the files from given directory that matches the filter
-def zipfilesindir(dst, src):
-    """
-    :param dst: full path with filename where the archive will be created
-    :param src: ARGS.directory - we will zip whatever is left in the directory
-    :return:
-    """
-    log.debug("In zipfilesindir, preparing to archive all file in " + src)
-    # sleep to allow system to finish processing file. We don't want an inuse or not found error
-    time.sleep(3)
-    dirpart = os.path.dirname(dst)
-    if not isdir(dirpart):
-        mkdir(dirpart)
-        log.debug("Archive directory " + dirpart + "created")
-    # fname = os.path.basename(dst)
-    zf = ZipFile(dst, "w")
-    abs_src = os.path.abspath(src)
-    for dirname, subdirs, files in os.walk(src):
-        for filename in files:
-            absname = os.path.abspath(os.path.join(dirname, filename))
-            arcname = absname[len(abs_src) + 1:]
-            log.debug("zipping " + os.path.join(dirname, filename) + " as " + arcname)
-            zf.write(absname, arcname)
-    zf.close()
-    log.info("Archive created: " + dst)
-
-
 def removefiles(dirname, dellist):
     # loop thru all files in the directory
     log.debug("In removefiles preparing to delete any unwanted files based on the --delete arg")
@@ -52,7 +26,6 @@ def removefiles(dirname, dellist):
         if fext in dellist:
             log.debug("deleting: " + dirname + sep + filename)
             os.remove(os.path.join(dirname,filename))
-    time.sleep(3)
 
 
 def kmh_from_mps(mps):
@@ -69,18 +42,6 @@ def hhmmss_from_seconds(sec):
     return formatted_time
 
 
-def decoding_decider(formattype, data):
-    """Helper function that decides if a decoding should happen or not."""
-    if formattype == "original":
-        # An original file (ZIP file) is binary and not UTF-8 encoded
-        data = data
-    elif data:
-        # GPX and TCX are textfiles and UTF-8 encoded
-        data = data.decode()
-
-    return data
-
-
 def write_to_file(filename, content, mode):
     """Helper function that persists content to file."""
     if filename.endswith(".json"):
@@ -91,6 +52,126 @@ def write_to_file(filename, content, mode):
     write_file.close()
 
 
+def gpx_trackpoints(filename, count=False):
+    """
+    Scan a GPX file for track points without building a tree of it: elements are dropped
+    as soon as they are parsed, so memory stays small for any file size.
+    :param count: go through the whole file for the number of points and their bounding box,
+                  otherwise stop at the first track point
+    :return: the number of track points (at most 1 without count) and the bounding box
+             (min lat, min lon, max lat, max lon), None without points or without count
+    """
+    points = 0
+    bbox = None
+    parents = []
+    for event, element in iterparse(filename, events=("start", "end")):
+        if event == "end":
+            # a parsed element is taken out of its parent, so the tree never grows
+            parents.pop()
+            if parents:
+                parents[-1].remove(element)
+            continue
+        parents.append(element)
+        # GPX 1.0 and 1.1 use different namespaces, compare the local name only
+        if element.tag.rsplit("}", 1)[-1] == "trkpt":
+            points += 1
+            if not count:
+                break
+            try:
+                lat = float(element.get("lat"))
+                lon = float(element.get("lon"))
+            except (TypeError, ValueError):
+                continue
+            if bbox is None:
+                bbox = (lat, lon, lat, lon)
+            else:
+                bbox = (min(bbox[0], lat), min(bbox[1], lon), max(bbox[2], lat), max(bbox[3], lon))
+    return points, bbox
+
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+
+def jsonelements(text):
+    """
+    Decode the elements of the JSON arrays in text one at a time, instead of the whole
+    array at once like json.loads. A page of the activity list is one array,
+    activity_list.json holds one array per page that was fetched.
+    :raise ValueError: where text is not an array of JSON values
+    """
+    decoder = json.JSONDecoder()
+    skip = _WHITESPACE.match
+    position = skip(text, 0).end()
+    while position < len(text):
+        if text[position] != "[":
+            raise ValueError("Expecting '[' at " + str(position))
+        position = skip(text, position + 1).end()
+        if text.startswith("]", position):
+            position = skip(text, position + 1).end()
+            continue
+        while True:
+            element, position = decoder.raw_decode(text, position)
+            yield element
+            position = skip(text, position).end()
+            if text.startswith(",", position):
+                position = skip(text, position + 1).end()
+            elif text.startswith("]", position):
+                position = skip(text, position + 1).end()
+                break
+            else:
+                raise ValueError("Expecting ',' or ']' at " + str(position))
+
+
+def lastjson(text):
+    """
+    Decode the last of the JSON documents in text. The JSON files of an activity were
+    appended to on every fetch by earlier versions, so they may hold more than one.
+    :raise ValueError: where text is not a sequence of JSON documents
+    """
+    decoder = json.JSONDecoder()
+    skip = _WHITESPACE.match
+    position = skip(text, 0).end()
+    if position == len(text):
+        raise ValueError("Expecting value at " + str(position))
+    while position < len(text):
+        document, position = decoder.raw_decode(text, position)
+        position = skip(text, position).end()
+    return document
+
+
+def jsonfields(chunks, keys):
+    """
+    Pick the values of some keys out of a JSON document that comes in binary chunks,
+    without parsing it. A key can't be mistaken for text in a string (the quotes in a
+    string are escaped), but nested keys are found as well: the first occurrence of a key
+    wins, so this is meant for top level keys that occur once, with a number as value.
+    :param chunks: iterable of bytes
+    :return: dict of the keys that were found
+    """
+    pattern = re.compile(rb'"(' + b"|".join(re.escape(key.encode()) for key in keys)
+                         + rb')"\s*:\s*(-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?|null|true|false)(?=\s*[,}\]])')
+    fields = {}
+    tail = b""
+    for chunk in chunks:
+        data = tail + chunk
+        # only a value followed by its delimiter is complete; a key or value cut off at the
+        # end of the chunk does not match yet, it is completed by the next one
+        tail = data[-128:]
+        for match in pattern.finditer(data):
+            fields.setdefault(match.group(1).decode(), json.loads(match.group(2)))
+    return fields
+
+
+def linkorcopy(source, destination):
+    """Put a file into the workflow directory as a hardlink, or as a copy on another filesystem."""
+    if isfile(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        copyfile(source, destination)
+
+
 def printverbose(verarg, vermsg):
     if verarg:
         print(vermsg)
@@ -33,24 +33,40 @@ Description:    Use this script to export your fitness data from Garmin Connect.
 
 
 import argparse
+import csv
+import itertools
 import json
 import logging
+import queue
 import sys
-import time
+import tempfile
+import threading
 import urllib.parse
 import urllib.request
 import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from getpass import getpass
-from os import mkdir, remove, stat
+from os import mkdir, stat
 from os.path import isdir, isfile, sep, join
-from shutil import copyfile
 from subprocess import call
 from sys import argv
-from xml.dom.minidom import parseString
+from xml.etree.ElementTree import ParseError
 
 import gceaccess
+import gcearchive
 import gceargs
+import gceasync
+import gcecache
+import gcecolumns
+import gcegear
+import gceindex
+import gcepack
+import gcepool
+import gcerate
+import gcerebuild
+import gcestore
 import gceutils
 
 log = logging.getLogger()
@@ -63,6 +79,12 @@ TOTAL_DOWNLOADED = 0
 TOTAL_COPIED = 0
 TOTAL_SKIPPED = 0
 TOTAL_RETRIEVED = 0
+# guards the TOTAL_* counters when activities are processed by several workers
+COUNTER_LOCK = threading.Lock()
+# with --unzip an original ZIP is kept in memory up to this size (beyond, in a temporary file)
+UNZIP_SPOOL_SIZE = 32 * 1024 * 1024
+# pages of the activity list that are fetched ahead of the one being processed
+PREFETCH_PAGES = 1
 
 # define the ARGs
 PARSER = argparse.ArgumentParser()
@@ -72,12 +94,39 @@ ARGS = PARSER.parse_args()
 if ARGS.debug:
     log.setLevel(logging.DEBUG)
 
+if ARGS.workers < 1 or ARGS.concurrency < 1:
+    print("--workers and --concurrency must be 1 or more")
+    sys.exit(2)
+
 if ARGS.version:
     print(argv[0] + ", version " + SCRIPT_VERSION)
     sys.exit(0)
 
-USERNAME = ARGS.username if ARGS.username else input("Username: ")
-PASSWORD = ARGS.password if ARGS.password else getpass()
+if ARGS.start_date and ARGS.end_date and ARGS.start_date > ARGS.end_date:
+    print("--start-date must not be after --end-date")
+    sys.exit(2)
+
+try:
+    COLUMNS = gcecolumns.select(ARGS.columns)
+except ValueError as column_error:
+    print("--columns: " + str(column_error))
+    sys.exit(2)
+# the csv row of an activity, extracted by the column descriptions prepared once here
+CSV_ROW = gcecolumns.rowbuilder(COLUMNS)
+
+# the data file formats of the fetch plan, in the order of --format
+FORMATS = ARGS.format if "data" in ARGS.fetch else []
+# the fetch plan as the index names the artifacts, a data file is its format
+FETCH_ARTIFACTS = {"summary": gceindex.SUMMARY, "device": gceindex.APP_INFO, "details": gceindex.DETAIL,
+                   "gear": gceindex.GEAR}
+FETCH = {FETCH_ARTIFACTS[name] for name in ARGS.fetch if name != "data"} | set(FORMATS)
+# an activity counts as exported once these artifacts of the plan are here: the data files if they
+# are planned, else the first JSON artifact of the plan
+EXPORTED = FORMATS or [next(artifact for artifact in gceindex.JSON_ARTIFACTS if artifact in FETCH)]
+# the data files of an activity in more than one format download in parallel, the worker thread
+# takes the first format and these threads the others
+DATA_POOL = ThreadPoolExecutor(max_workers=ARGS.workers * (len(FORMATS) - 1),
+                               thread_name_prefix="data") if len(FORMATS) > 1 else None
 
 
 def getallfiles():
@@ -85,229 +134,667 @@ def getallfiles():
     # on the profile page to know how many are available
     user_stats = gceaccess.query_garmin_stats()
     # Persist JSON
-    gceutils.write_to_file(ARGS.directory + sep + "userstats.json", user_stats.decode(), "a")
+    gceaccess.writejson(ARGS.directory + sep + "userstats.json", user_stats.decode())
     # Modify total_to_download based on how many activities the server reports.
     json_user = json.loads(user_stats)
     return int(json_user["userMetrics"][0]["totalActivities"])
 
 
-def downloadfile(actid):
+def fetchactivitylist(search_parms):
+    """Query one page of the activity list, persist it and return the raw JSON."""
+    log.debug("Search parms" + str(search_parms))
+    # Query Garmin Connect
+    log.debug("Activity list URL: " + gceaccess.URL_GC_LIST + urllib.parse.urlencode(search_parms))
+    with gceaccess.METRICS.stage("list_page"):
+        activity_list = gceaccess.http_req(gceaccess.URL_GC_LIST + urllib.parse.urlencode(search_parms))
+        gceaccess.writejson(ARGS.directory + sep + "activity_list.json", activity_list.decode())
+    return activity_list
+
+
+def searchfilter():
+    """The --start-date, --end-date and --activity-type filter as parameters of the activity list search."""
+    search_filter = {}
+    if ARGS.start_date:
+        search_filter["startDate"] = ARGS.start_date
+    if ARGS.end_date:
+        search_filter["endDate"] = ARGS.end_date
+    if ARGS.activity_type:
+        search_filter["activityType"] = ARGS.activity_type
+    return search_filter
+
+
+def prefetchpages(chunks, search_filter=None):
+    """
+    List the activities chunk by chunk in a background thread, ahead of the caller: while
+    the activities of one page are processed the next page is already fetched, so the
+    workers never wait for the activity list. At most PREFETCH_PAGES pages wait in
+    the queue, the thread stops until the caller takes one. The listing ends with the first
+    empty page; only its first entry is decoded to tell, the caller decodes the pages.
+    :param chunks: (start, limit) of the pages, may be endless
+    :param search_filter: parameters of searchfilter() for every page
+    :return: generator of the pages, in order, each a generator of its activities that are
+             decoded one at a time; an error of the listing is raised in the caller
+    """
+    pages = queue.Queue(PREFETCH_PAGES)
+
+    def produce():
+        try:
+            for start, limit in chunks:
+                page = fetchactivitylist(dict(search_filter or {}, start=start, limit=limit)).decode()
+                if next(gceutils.jsonelements(page), None) is None:
+                    break
+                pages.put(page)
+        except Exception as error:
+            pages.put(error)
+            return
+        pages.put(None)
+
+    # a daemon, so a failed export does not wait for a thread blocked on the full queue
+    threading.Thread(target=produce, name="activity-list", daemon=True).start()
+    while True:
+        page = pages.get()
+        if page is None:
+            return
+        if isinstance(page, Exception):
+            raise page
+        yield gceutils.jsonelements(page)
+
+
+def isexported(a):
+    """
+    True if the data files of the activity are already here in every format (--index lookup or
+    file probes); the first JSON artifact of the fetch plan when --fetch leaves out the data file.
+    """
+    stractid = str(a["activityId"])
+    if INDEX:
+        return INDEX.fetched(stractid).issuperset(EXPORTED)
+    if FORMATS:
+        return all(downloadfile(stractid, export_format, quiet=True)[0] == 1 for export_format in FORMATS)
+    return gceaccess.hasartifact(ARGS.directory + sep + stractid + gceindex.JSON_SUFFIXES[EXPORTED[0]])
+
+
+def downloadfile(actid, export_format, quiet=False):
     """
     Download the file from the garmin site in the requested format. If the file already exists
     in the directory the return value is 1 else the download url, filemode and filename are returned
     :param actid:
+    :param export_format: one of the formats of --format, each has its own file
+    :param quiet: don't print the skipping message
     :return:
     """
     fitfilename = ""
+    zipfitfilename = ""
     tcxfilename = ""
     gpxfilename = ""
-    if ARGS.format == "gpx":
+    if export_format == "gpx":
         datafilename = (ARGS.directory + sep + actid + "_activity.gpx")
         downloadurl = gceaccess.URL_GC_GPX_ACTIVITY + actid + "?full=true"
         log.debug("DownloadURL: " + downloadurl)
         filemode = "w"
-    elif ARGS.format == "tcx":
+    elif export_format == "tcx":
         datafilename = (ARGS.directory + sep + actid + "_activity.tcx")
         downloadurl = gceaccess.URL_GC_TCX_ACTIVITY + actid + "?full=true"
         log.debug("DownloadURL: " + downloadurl)
         filemode = "w"
     else:
         # some original files may not contain a .fit file. They may only have extracted a gpx or tcx
-        # so we want to check for all types here.
+        # so we want to check for all types here. The FIT file in the ZIP is named <id>_ACTIVITY.fit
         datafilename = (ARGS.directory + sep + actid + "_activity.zip")
         fitfilename = (ARGS.directory + sep + actid + ".fit")
+        zipfitfilename = (ARGS.directory + sep + actid + "_ACTIVITY.fit")
         tcxfilename = (ARGS.directory + sep + actid + ".tcx")
         gpxfilename = (ARGS.directory + sep + actid + ".gpx")
         downloadurl = gceaccess.URL_GC_ORIGINAL_ACTIVITY + actid
         log.debug("DownloadURL: " + downloadurl)
         filemode = "wb"
 
-    if ARGS.format != "original" and isfile(datafilename):
-        print("\tData file already exists; skipping...")
+    # with --index the skip decision was already made by processone from the index
+    if INDEX:
+        return downloadurl, filemode, datafilename
+
+    if export_format != "original" and isfile(datafilename):
+        if not quiet:
+            print("\tData file already exists; skipping...")
         return 1, 1, 1
 
     # Regardless of unzip setting, don't redownload if the ZIP or FIT file exists.
     # some original files only contain tcx or gpx - check for all types before downloading
-    if ARGS.format == "original" \
+    if export_format == "original" \
             and (isfile(datafilename)
                  or isfile(fitfilename)
+                 or isfile(zipfitfilename)
                  or isfile(tcxfilename)
                  or isfile(gpxfilename)):
-        print("\tFIT data file already exists; skipping...")
+        if not quiet:
+            print("\tFIT data file already exists; skipping...")
         return 1, 1, 1
 
     return downloadurl, filemode, datafilename
 
 
-def finalizefiles(data, data_filename, friendly_filename):
+def finalizefiles(data_filename, export_format, friendly_filename, zip_data=None):
     """
     Finalize the datfile processing. If we are using format gpx see if we have tracks. If we are using
-    original and the unzip option was selected unzip the file and remove the original file
-
+    original and the unzip option was selected unzip the downloaded file
+    :param export_format: the format of data_filename
+    :param zip_data: with --unzip, the downloaded ZIP as a binary file object; it is never written to disk
+    :return: the data files left in the export directory
     """
     global TOTAL_COPIED
-    if ARGS.format == "gpx" and data:
+    data_files = [data_filename]
+    if export_format == "gpx" and stat(data_filename).st_size:
         # Validate GPX data. If we have an activity without GPS data (e.g., running on a
         # treadmill), Garmin Connect still kicks out a GPX (sometimes), but there is only
-        # activity information, no GPS data. N.B. You can omit the XML parse (and the
-        # associated log messages) to speed things up.
-        gpx = parseString(data)
-        if gpx.getElementsByTagName("trkpt"):
-            gceutils.printverbose(ARGS.verbose, "Done. GPX data saved.")
+        # activity information, no GPS data. The file is scanned, not parsed into a DOM, and
+        # the scan stops at the first track point unless --verbose asks for the statistics.
+        try:
+            points, bbox = gceutils.gpx_trackpoints(data_filename, ARGS.verbose)
+        except ParseError as error:
+            print("Invalid GPX data in " + data_filename + ": " + str(error))
+            return data_files
+        if points:
+            gceutils.printverbose(ARGS.verbose, "Done. GPX data saved, " + str(points) + " track points"
+                                  + ("" if bbox is None else ", bounding box " + ", ".join(str(c) for c in bbox)) + ".")
         else:
             gceutils.printverbose(ARGS.verbose, "Done. No track points found.")
-    elif ARGS.format == "original":
-        # Even manual upload of a GPX file is zipped, but we'll validate the extension.
-        if ARGS.unzip and data_filename[-3:].lower() == "zip":
-            gceutils.printverbose(ARGS.verbose, "Unzipping and removing original files...")
-            try:
-                gceutils.printverbose(ARGS.verbose, "Filesize is: " + str(stat(data_filename).st_size))
-            except Exception as ferror:
-                print("Unable to determine file stats for " + data_filename + "Error: " + str(ferror))
-                return
-            if stat(data_filename).st_size > 0:
-                zip_file = open(data_filename, "rb")
-                z = zipfile.ZipFile(zip_file)
-                for name in z.namelist():
-                    z.extract(name, ARGS.directory)
-                    log.debug("extracting file: " + ARGS.directory + sep + name) 
-                    if len(ARGS.workflowdirectory) and join(ARGS.directory, name) != join(ARGS.workflowdirectory, name):
-                        copyfile(join(ARGS.directory, name), join(ARGS.workflowdirectory, friendly_filename))
-                        gceutils.printverbose(ARGS.verbose, 'copy file to: ' + ARGS.workflowdirectory + sep + friendly_filename)
-                        TOTAL_COPIED += 1
-                zip_file.close()
+    elif export_format == "original":
+        # Even manual upload of a GPX file is zipped
+        if zip_data is not None:
+            gceutils.printverbose(ARGS.verbose, "Unzipping original files...")
+            zip_size = zip_data.seek(0, 2)
+            gceutils.printverbose(ARGS.verbose, "Filesize is: " + str(zip_size))
+            data_files = []
+            if zip_size > 0:
+                zip_data.seek(0)
+                with zipfile.ZipFile(zip_data) as z:
+                    for name in z.namelist():
+                        extracted = z.extract(name, ARGS.directory)
+                        data_files.append(extracted)
+                        log.debug("extracting file: " + extracted)
+                        if len(ARGS.workflowdirectory) and extracted != join(ARGS.workflowdirectory, name):
+                            gceutils.linkorcopy(extracted, join(ARGS.workflowdirectory, friendly_filename))
+                            gceutils.printverbose(ARGS.verbose, 'copy file to: ' + ARGS.workflowdirectory + sep + friendly_filename)
+                            with COUNTER_LOCK:
+                                TOTAL_COPIED += 1
             else:
                 gceutils.printverbose(ARGS.verbose, "Skipping 0Kb zip file.")
-            remove(data_filename)
         gceutils.printverbose(ARGS.verbose, "Done, getting next file")
-        time.sleep(3)
     else:
         gceutils.printverbose(ARGS.verbose, "Done, getting next file.")
+    return data_files
+
 
+def fetchdata(download_url, export_format, data_filename):
+    """
+    Download one data file of an activity, in a worker thread or in DATA_POOL.
+    :return: True if Garmin had the file, and the spooled ZIP of an original that is unzipped
+             (None for the other formats)
+    """
+    # the data goes to disk as it arrives, the response is never held in memory; an
+    # original that is unzipped anyway is extracted from memory instead
+    if export_format == "original" and ARGS.unzip:
+        zip_data = tempfile.SpooledTemporaryFile(UNZIP_SPOOL_SIZE)
+        target = zip_data
+    else:
+        zip_data = None
+        target = data_filename
+    if not gceaccess.download_data(download_url, export_format, target):
+        print("/tempty file, no data existed in the downloaded file")
+        if zip_data is not None:
+            zip_data.close()
+        return False, None
+    return True, zip_data
+
+
+def prefetchactivity(a):
+    """
+    With --engine asyncio, start the summary and gear requests of an activity that
+    is not downloaded yet, so they are answered by the time a worker gets to it.
+    """
+    stractid = str(a["activityId"])
+    have = INDEX.fetched(stractid) if INDEX else set()
+    if not INDEX and isexported(a):
+        return
+    if have.issuperset(FETCH):
+        return
+    if gceindex.SUMMARY in FETCH and gceindex.SUMMARY not in have:
+        gceaccess.prefetch(gceaccess.URL_GC_ACTIVITY + stractid)
+    if gceindex.GEAR in FETCH and gceindex.GEAR not in have and not gceaccess.GEAR_RESOLVER:
+        gceaccess.prefetch(gceaccess.URL_GEAR_DETAIL + "activityId=" + stractid)
 
-def processactivity(alist):
+
+def dropprefetched(stractid):
+    """Drop what prefetchactivity started for an activity that processone gives up on."""
+    gceaccess.dropprefetch(gceaccess.URL_GC_ACTIVITY + stractid,
+                           gceaccess.URL_GEAR_DETAIL + "activityId=" + stractid)
+
+
+def processone(a, ahead=None):
+    """
+    Download and finalize a single activity from the activity list. This runs in a worker
+    thread when --workers is greater than 1, so the shared counters are only changed while
+    holding COUNTER_LOCK.
+    :param a: the activity entry from the activity list
+    :param ahead: an activity further down the list to prefetch (--engine asyncio)
+    :return: the csv row of the activity, or None if nothing was retrieved or an earlier run
+             already wrote its row
+    """
     global TOTAL_SKIPPED, TOTAL_RETRIEVED
-    for a in alist:
-        # create a string from the activity to avoid having to use the str function multiple times.
-        stractid = str(a["activityId"])
-        # Display which entry we're working on.
-        print("Garmin Connect activity: [" + stractid + "]  " + str(a["activityName"]))
-        # download the file from Garmin
-        download_url, file_mode, data_filename = downloadfile(stractid)
-        # if the file already existed go get the next file
-        if download_url == 1:
+    if ahead:
+        prefetchactivity(ahead)
+    # create a string from the activity to avoid having to use the str function multiple times.
+    stractid = str(a["activityId"])
+    # Display which entry we're working on.
+    print("Garmin Connect activity: [" + stractid + "]  " + str(a["activityName"]))
+    # with --index one lookup tells what an earlier run already fetched for this activity
+    have = set()
+    if INDEX:
+        have = INDEX.fetched(stractid)
+    # without the index the data files decide below, without the data files in the plan the
+    # first JSON artifact of the plan
+    if have.issuperset(FETCH) or (not INDEX and not FORMATS and isexported(a)):
+        print("\tActivity already exported; skipping...")
+        with COUNTER_LOCK:
             TOTAL_SKIPPED += 1
+        return None
+    # one target per format that is missing
+    downloads = []
+    for export_format in FORMATS:
+        if export_format in have:
             continue
-        # extract the data from the downloaded file
-        data = gceaccess.download_data(download_url, ARGS.format)
-        # if the original zip has no data
-        if data == "":
-            print("/tempty file, no data existed in the downloaded file")
-            continue
-        
-        TOTAL_RETRIEVED += 1
-        # write the file
-        gceutils.write_to_file(data_filename, gceutils.decoding_decider(ARGS.format, data), file_mode)
+        download_url, file_mode, data_filename = downloadfile(stractid, export_format)
+        if download_url != 1:
+            downloads.append((download_url, export_format, data_filename))
+    # if the files already existed go get the next activity
+    if FORMATS and not INDEX and not downloads:
+        with COUNTER_LOCK:
+            TOTAL_SKIPPED += 1
+        return None
+    # the data files that were written: format, file name and the ZIP to unzip
+    fetched = []
+    if downloads:
+        # download the files from Garmin, the first format here and the others in parallel
+        futures = [DATA_POOL.submit(fetchdata, *download) for download in downloads[1:]]
+        results = [fetchdata(*downloads[0])] + [future.result() for future in futures]
+        fetched = [(export_format, data_filename, zip_data)
+                   for (download_url, export_format, data_filename), (written, zip_data) in zip(downloads, results)
+                   if written]
+        if not fetched:
+            dropprefetched(stractid)
+            return None
+
+        with COUNTER_LOCK:
+            TOTAL_RETRIEVED += 1
+    elif FORMATS:
+        print("\tData file already exists; fetching the missing JSON files...")
+    summary_filename = ARGS.directory + sep + stractid + "_activity_summary.json"
+    if not INDEX and gceaccess.hasartifact(summary_filename):
+        # without the index the summary tells an earlier run, which wrote the row: what it
+        # stored is read as with the index, only a missing artifact is fetched
+        have = set(gceindex.JSON_ARTIFACTS)
+    activity_summary = None
+    if gceindex.SUMMARY in have:
+        activity_summary = gceaccess.readartifact(summary_filename)
+    if activity_summary is None and gceindex.SUMMARY in FETCH:
         log.debug("Activity summary URL: " + gceaccess.URL_GC_ACTIVITY + stractid)
         # get the summary info, if unavailable go get next file
         try:
             activity_summary = gceaccess.http_req(gceaccess.URL_GC_ACTIVITY + stractid)
         except Exception as aerror:
             print("unable to get activity " + str(aerror))
-            continue
+            dropprefetched(stractid)
+            return None
         # write the summary file
-        gceutils.write_to_file(ARGS.directory + sep + stractid + "_activity_summary.json",
-                               activity_summary.decode(), "a", )
-        # build the json format files
-        json_summary, json_gear, json_device, json_detail = gceaccess.createjson(ARGS.directory,
-                                                                                 stractid, activity_summary)
-        # CSV_FILE.write(csv_record)
-        CSV_FILE.write(gceaccess.buildcsvrecord(a, json_summary, json_gear, json_device, json_detail))
-        friendly_filename = gceaccess.buildFriendlyFilename(a, json_summary, json_gear, json_device, json_detail, ARGS)
-        finalizefiles(data, data_filename, friendly_filename)
-
-print("Welcome to Garmin Connect Exporter!")
-
-# Create directory for data files.
-if isdir(ARGS.directory):
-    print(
-        "Warning: Output directory already exists. Will skip already-downloaded files and \
-append to the CSV file."
-    )
-
-try:
-    gceaccess.gclogin(USERNAME, PASSWORD)
-except Exception as error:
-    print(error)
-    sys.exit(8)
-
-# create the activities directory if it is not there
-if not isdir(ARGS.directory):
-    mkdir(ARGS.directory)
-    
-if len(ARGS.workflowdirectory):
-    if not isdir(ARGS.workflowdirectory):
-        mkdir(ARGS.workflowdirectory)
-
-CSV_FILENAME = ARGS.directory + sep + "activities.csv"
-CSV_EXISTED = isfile(CSV_FILENAME)
-CSV_FILE = open(CSV_FILENAME, "a", encoding="utf-8")
-if not CSV_EXISTED:
-    CSV_FILE.write(gceaccess.csvheader())
-
-if ARGS.count == "all":
-    TOTAL_TO_DOWNLOAD = getallfiles()
-else:
-    TOTAL_TO_DOWNLOAD = int(ARGS.count)
-
-print("Total to download: " + str(TOTAL_TO_DOWNLOAD))
-
-# This while loop will download data from the server in multiple chunks, if necessary.
-while TOTAL_DOWNLOADED < TOTAL_TO_DOWNLOAD:
-    # Maximum chunk size 'limit_maximum' ... 400 return status if over maximum.  So download
-    # maximum or whatever remains if less than maximum.
-    # As of 2018-03-06 I get return status 500 if over maximum
-    if TOTAL_TO_DOWNLOAD - TOTAL_DOWNLOADED > gceaccess.LIMIT_MAXIMUM:
-        NUM_TO_DOWNLOAD = gceaccess.LIMIT_MAXIMUM
+        gceaccess.writejson(summary_filename, activity_summary.decode())
+        if INDEX:
+            INDEX.record(stractid, gceindex.SUMMARY, summary_filename)
+    # build the json format files
+    json_summary, json_gear, json_device, json_detail = gceaccess.createjson(ARGS.directory, stractid,
+                                                                             activity_summary, have, FETCH)
+    if INDEX:
+        for artifact, json_artifact in ((gceindex.APP_INFO, json_device), (gceindex.DETAIL, json_detail),
+                                        (gceindex.GEAR, json_gear)):
+            if artifact not in have and json_artifact is not None:
+                INDEX.record(stractid, artifact, ARGS.directory + sep + stractid + gceindex.JSON_SUFFIXES[artifact])
+    with gceaccess.METRICS.stage("rows"):
+        csv_record = CSV_ROW(a, json_summary, json_gear, json_device, json_detail)
+        if STORE:
+            STORE.put(a, json_summary, json_gear, json_device, json_detail)
+    friendly_filename = gceaccess.buildFriendlyFilename(a, json_summary, json_gear, json_device, json_detail, ARGS)
+    for export_format, data_filename, zip_data in fetched:
+        with gceaccess.METRICS.stage("finalize"):
+            data_files = finalizefiles(data_filename, export_format, friendly_filename, zip_data)
+        if zip_data is not None:
+            zip_data.close()
+        if INDEX:
+            INDEX.record(stractid, export_format, data_files[0] if data_files else data_filename)
+    # an activity an earlier run exported got its row then, only missing files were fetched
+    # now; --rebuild-csv writes the rows again with them
+    if have:
+        return None
+    return csv_record
+
+
+def processactivity(activities):
+    """
+    Process one page of the activity list. The activities are handed to a pool of
+    ARGS.workers threads and their CSV records are written in list order, so in the same
+    order as the sequential export would write them. The activities are taken from the
+    iterable as workers get free, a page that is decoded entry by entry is never held as a
+    whole. With the asyncio engine the requests of the next activities in a window of
+    ARGS.concurrency / 3 are started ahead of the workers.
+    :return: the number of activities of the page
+    """
+    window = max(1, ARGS.concurrency // 3) if gceaccess.ENGINE else 0
+    processed = 0
+    with ThreadPoolExecutor(max_workers=ARGS.workers) as executor:
+        futures = deque()
+        for a, ahead in withahead(activities, window):
+            futures.append(executor.submit(processone, a, ahead))
+            # a few activities queue up for the workers, the rest stays in the iterable
+            if len(futures) > 2 * ARGS.workers:
+                processed += writerecord(futures.popleft().result())
+        while futures:
+            processed += writerecord(futures.popleft().result())
+    with gceaccess.METRICS.stage("commit"):
+        if STORE:
+            STORE.commit()
+        if gceaccess.PACK:
+            gceaccess.PACK.flush()
+    return processed
+
+
+def withahead(activities, window):
+    """
+    Pair every activity with the one window places further down for processone to
+    prefetch (None without a window); the first window activities are prefetched here.
+    """
+    following = deque()
+    for a in activities:
+        if not window:
+            yield a, None
+            continue
+        following.append(a)
+        if len(following) <= window:
+            prefetchactivity(a)
+        else:
+            yield following.popleft(), a
+    while following:
+        yield following.popleft(), None
+
+
+def writerecord(csv_record):
+    """Write the csv record of processone, if there is one; return 1 for the activity."""
+    if csv_record:
+        CSV_WRITER.writerow(csv_record)
+    return 1
+
+
+def csvheader(filename):
+    """The header row of an existing csv file, None if there is no file or it is empty."""
+    try:
+        with open(filename, encoding="utf-8", newline="") as csv_file:
+            return next(csv.reader(csv_file), None)
+    except OSError:
+        return None
+
+
+def writereport(totals):
+    """Write the timing report of the run."""
+    try:
+        gceaccess.METRICS.writejson(ARGS.report or join(ARGS.directory, "export_report.json"), totals)
+    except OSError as error:
+        print("Unable to write the run report: " + str(error))
+
+
+def writeprometheus(totals):
+    """Write the Prometheus file, if asked for."""
+    if not ARGS.prometheus:
+        return
+    try:
+        gceaccess.METRICS.writeprometheus(ARGS.prometheus, totals)
+    except OSError as error:
+        print("Unable to write the Prometheus metrics: " + str(error))
+
+# the export runs only when started as a script; worker processes that import this file
+# (multiprocessing starts them with spawn on Windows and macOS) just get the definitions
+if __name__ == "__main__":
+    print("Welcome to Garmin Connect Exporter!")
+
+    STORE = None
+    if ARGS.rebuild_csv:
+        # no login and no requests, everything comes from the JSON files of earlier runs
+        try:
+            if ARGS.storage == "pack":
+                gceaccess.PACK = gcepack.PackStore(ARGS.directory, ARGS.pack_compression)
+            if ARGS.summary_db:
+                STORE = gcestore.SummaryStore(join(ARGS.directory, "activities.sqlite"))
+            with gceaccess.METRICS.stage("rebuild"):
+                REBUILT, COPIED = gcerebuild.rebuild(ARGS.directory, ARGS.columns, ARGS.workflowdirectory,
+                                                     store=STORE)
+        except Exception as error:
+            print(error)
+            sys.exit(1)
+        if STORE:
+            STORE.close()
+        if gceaccess.PACK:
+            gceaccess.PACK.close()
+        writereport({"rows_written": REBUILT, "copied": COPIED})
+        writeprometheus({"rows_written": REBUILT, "copied": COPIED})
+        print("Rows written......." + str(REBUILT))
+        print("Total Copied......." + str(COPIED))
+        print("Done!")
+        sys.exit(0)
+
+    # Create directory for data files.
+    if isdir(ARGS.directory):
+        print(
+            "Warning: Output directory already exists. Will skip already-downloaded files and "
+            "append to the CSV file."
+        )
+        # rows are appended under the header of the existing file, it must have the same columns
+        CSV_HEADER = csvheader(ARGS.directory + sep + "activities.csv")
+        if CSV_HEADER is not None and CSV_HEADER != gcecolumns.header(COLUMNS):
+            print("activities.csv has other columns than --columns asks for; run with the same --columns, "
+                  "or write it again with --rebuild-csv --columns ...")
+            sys.exit(2)
+
+    if ARGS.base_url:
+        gceaccess.setbaseurl(ARGS.base_url)
+
+    # pace the requests per host, the workers share this limiter; it speeds up while Garmin
+    # answers fine and backs off on 429, 5xx and timeouts
+    gceaccess.RATE_LIMITER = gcerate.AdaptiveRateLimiter(ARGS.rate, ARGS.max_rate)
+    # a stalled connection fails after the timeout instead of hanging the export, GETs are retried
+    gceaccess.CONNECT_TIMEOUT = ARGS.connect_timeout
+    gceaccess.READ_TIMEOUT = ARGS.read_timeout
+    gceaccess.RETRIES = ARGS.retries
+    if ARGS.keepalive:
+        gceaccess.POOL = gcepool.ConnectionPool(gceaccess.COOKIE_JAR, gceaccess.USER_AGENT,
+                                                ARGS.workers * max(1, len(FORMATS)),
+                                                ARGS.connect_timeout, ARGS.read_timeout)
+    if ARGS.engine == "asyncio":
+        # all requests go through one event loop; urllib stays the default
+        # all of the API is on one host, so that host may take all of --concurrency
+        gceaccess.ENGINE = gceasync.AsyncEngine(gceaccess.COOKIE_JAR, gceaccess.USER_AGENT,
+                                                ARGS.concurrency, gceaccess.RATE_LIMITER,
+                                                per_host=ARGS.concurrency,
+                                                connect_timeout=ARGS.connect_timeout,
+                                                read_timeout=ARGS.read_timeout)
+
+    # a stored session saves the three login round trips as long as Garmin still accepts it
+    if ARGS.session_file and gceaccess.loadsession(ARGS.session_file) and gceaccess.sessionvalid():
+        print("Reusing the stored Garmin Connect session.")
     else:
-        NUM_TO_DOWNLOAD = TOTAL_TO_DOWNLOAD - TOTAL_DOWNLOADED
-
-    gceutils.printverbose(ARGS.verbose, "Number left to download = " + str(NUM_TO_DOWNLOAD))
+        USERNAME = ARGS.username if ARGS.username else input("Username: ")
+        PASSWORD = ARGS.password if ARGS.password else getpass()
+        try:
+            with gceaccess.METRICS.stage("login"):
+                gceaccess.gclogin(USERNAME, PASSWORD)
+        except Exception as error:
+            print(error)
+            sys.exit(8)
+        if ARGS.session_file:
+            gceaccess.savesession(ARGS.session_file)
+
+    # create the activities directory if it is not there
+    if not isdir(ARGS.directory):
+        mkdir(ARGS.directory)
+
+    if len(ARGS.workflowdirectory):
+        if not isdir(ARGS.workflowdirectory):
+            mkdir(ARGS.workflowdirectory)
+
+    INDEX = gceindex.SyncIndex(ARGS.directory) if ARGS.index else None
+    if ARGS.storage == "pack":
+        # the JSON artifacts go compressed into one pack file instead of thousands of small files
+        try:
+            gceaccess.PACK = gcepack.PackStore(ARGS.directory, ARGS.pack_compression)
+        except Exception as error:
+            print(error)
+            sys.exit(1)
+    if ARGS.bulk_gear:
+        gceaccess.GEAR_RESOLVER = gcegear.GearResolver(ARGS.directory + sep + ".gear_cache.json")
+    if ARGS.device_cache_ttl > 0:
+        gceaccess.DEVICE_CACHE = gcecache.TTLCache(ARGS.directory + sep + ".device_cache.json",
+                                                   ARGS.device_cache_ttl * 3600)
+
+    if ARGS.summary_db:
+        STORE = gcestore.SummaryStore(ARGS.directory + sep + "activities.sqlite")
+
+    CSV_FILENAME = ARGS.directory + sep + "activities.csv"
+    CSV_EXISTED = isfile(CSV_FILENAME)
+    CSV_FILE = open(CSV_FILENAME, "a", encoding="utf-8", newline="")
+    CSV_WRITER = csv.writer(CSV_FILE, lineterminator="\n")
+    if not CSV_EXISTED:
+        CSV_WRITER.writerow(gcecolumns.header(COLUMNS))
+
+    # Garmin does the filtering, activities outside of the filter are never listed
+    SEARCH_FILTER = searchfilter()
+    if ARGS.incremental:
+        # newest first in small pages, until the first activity that is already here
+        start = 0
+        while True:
+            search_parms = dict(SEARCH_FILTER, start=start, limit=gceaccess.LIMIT_INCREMENTAL)
+            alist = json.loads(fetchactivitylist(search_parms))
+            new_activities = []
+            for a in alist:
+                if isexported(a):
+                    break
+                new_activities.append(a)
+            TOTAL_TO_DOWNLOAD += len(new_activities)
+            processactivity(new_activities)
+            if len(new_activities) < len(alist) or len(alist) < gceaccess.LIMIT_INCREMENTAL:
+                break
+            start += gceaccess.LIMIT_INCREMENTAL
+        print("Total new activities: " + str(TOTAL_TO_DOWNLOAD))
+    elif SEARCH_FILTER:
+        # the user stats only know the total of all activities, the matching ones are
+        # counted as their pages come in below
+        TOTAL_TO_DOWNLOAD = 0 if ARGS.count == "all" else int(ARGS.count)
+        print("Total to download: " + ("all" if ARGS.count == "all" else ARGS.count) + " matching activities")
+    else:
+        if ARGS.count == "all":
+            TOTAL_TO_DOWNLOAD = getallfiles()
+        else:
+            TOTAL_TO_DOWNLOAD = int(ARGS.count)
 
-    search_parms = {"start": TOTAL_DOWNLOADED, "limit": NUM_TO_DOWNLOAD}
-    log.debug("Search parms" + str(search_parms))
+        print("Total to download: " + str(TOTAL_TO_DOWNLOAD))
 
-    # Query Garmin Connect
-    log.debug("Activity list URL: " + gceaccess.URL_GC_LIST + urllib.parse.urlencode(search_parms))
-    activity_list = gceaccess.http_req(gceaccess.URL_GC_LIST + urllib.parse.urlencode(search_parms))
-    gceutils.write_to_file(ARGS.directory + sep + "activity_list.json", activity_list.decode(), "a")
-
-    processactivity(json.loads(activity_list))
-    TOTAL_DOWNLOADED += NUM_TO_DOWNLOAD
-# End while loop for multiple chunks.
-
-CSV_FILE.close()
-
-# delete the json and csv files before archiving. If requested
-if ARGS.delete is not None:
-    print("deleting types " + str(ARGS.delete) + " from the output directory")
-    gceutils.removefiles(ARGS.directory, ARGS.delete)
-
-# archive the downloaded files
-if ARGS.archive:
-    print("archiving the downloaded files to: " + ARGS.archive)
-    gceutils.zipfilesindir(ARGS.archive, ARGS.directory)
-
-# print the final counts
-print("Total Requested...." + str(TOTAL_TO_DOWNLOAD))
-print("Total Downloaded..." + str(TOTAL_RETRIEVED))
-print("Total Copied......." + str(TOTAL_COPIED))
-print("Total Skipped......" + str(TOTAL_SKIPPED))
-
-# open the csv file in an external program if requested
-if len(ARGS.external):
-    print("Open CSV output: " + CSV_FILENAME)
-    # open CSV file. Comment this line out if you don't want this behavior
-    call([ARGS.external, "--" + ARGS.args, CSV_FILENAME])
-
-print("Done!")
+    # The activities are listed in chunks. Maximum chunk size 'limit_maximum' ... 400 return
+    # status if over maximum.  So download maximum or whatever remains if less than maximum.
+    # As of 2018-03-06 I get return status 500 if over maximum
+    if SEARCH_FILTER and not ARGS.incremental and ARGS.count == "all":
+        # all matching activities: pages until one comes back short
+        CHUNKS = ((start, gceaccess.LIMIT_MAXIMUM) for start in itertools.count(0, gceaccess.LIMIT_MAXIMUM))
+    else:
+        CHUNKS = [(start, min(gceaccess.LIMIT_MAXIMUM, TOTAL_TO_DOWNLOAD - start))
+                  for start in range(0, 0 if ARGS.incremental else TOTAL_TO_DOWNLOAD, gceaccess.LIMIT_MAXIMUM)]
+    # the next chunk is listed while the activities of this one are processed
+    for activity_page in prefetchpages(CHUNKS, SEARCH_FILTER):
+        if not SEARCH_FILTER:
+            gceutils.printverbose(ARGS.verbose, "Number left to download = " + str(TOTAL_TO_DOWNLOAD - TOTAL_DOWNLOADED))
+        TOTAL_DOWNLOADED += processactivity(activity_page)
+    if SEARCH_FILTER and not ARGS.incremental:
+        TOTAL_TO_DOWNLOAD = TOTAL_DOWNLOADED
+        print("Matching activities: " + str(TOTAL_TO_DOWNLOAD))
+
+    CSV_FILE.close()
+    if STORE:
+        STORE.close()
+    if gceaccess.PACK:
+        gceaccess.PACK.close()
+    if INDEX:
+        INDEX.close()
+    if gceaccess.DEVICE_CACHE:
+        gceaccess.DEVICE_CACHE.save()
+    if gceaccess.GEAR_RESOLVER:
+        gceaccess.GEAR_RESOLVER.save()
+
+    # the session cookies may have been refreshed during the run
+    if ARGS.session_file:
+        gceaccess.savesession(ARGS.session_file)
+
+    # keep-alive statistics, fewer connections than requests means connections were reused
+    TRANSPORT = gceaccess.ENGINE or gceaccess.POOL
+    if TRANSPORT:
+        TRANSPORT_STATS = TRANSPORT.stats()
+        TRANSPORT.close()
+
+    # delete the json and csv files before archiving. If requested
+    if ARGS.delete is not None:
+        print("deleting types " + str(ARGS.delete) + " from the output directory")
+        with gceaccess.METRICS.stage("delete"):
+            gceutils.removefiles(ARGS.directory, ARGS.delete)
+
+    # the report of where the time went; it is in the export directory by default, so it is
+    # written before archiving and the archive gets the report of this run
+    TOTALS = {"requested": TOTAL_TO_DOWNLOAD, "downloaded": TOTAL_RETRIEVED, "copied": TOTAL_COPIED,
+              "skipped": TOTAL_SKIPPED}
+    if gceaccess.DEVICE_CACHE:
+        TOTALS.update(device_cache_hits=gceaccess.DEVICE_CACHE.hits,
+                      device_cache_misses=gceaccess.DEVICE_CACHE.misses)
+    if gceaccess.GEAR_RESOLVER:
+        TOTALS["gear_requests"] = gceaccess.GEAR_RESOLVER.requests
+    writereport(TOTALS)
+
+    # archive the downloaded files
+    if ARGS.archive:
+        print("archiving the downloaded files to: " + ARGS.archive)
+        with gceaccess.METRICS.stage("archive"):
+            ARCHIVED = gcearchive.updatearchive(ARGS.archive, ARGS.directory, ARGS.archive_level)
+        print(str(ARCHIVED) + " new or changed files archived")
+    # the Prometheus file is for the node exporter, outside of the export; the archive stage is in it
+    writeprometheus(TOTALS)
+
+    # print the final counts
+    print("Total Requested...." + str(TOTAL_TO_DOWNLOAD))
+    print("Total Downloaded..." + str(TOTAL_RETRIEVED))
+    print("Total Copied......." + str(TOTAL_COPIED))
+    print("Total Skipped......" + str(TOTAL_SKIPPED))
+    if gceaccess.DEVICE_CACHE:
+        # every hit is a device request that was not sent
+        print("Device cache......." + str(gceaccess.DEVICE_CACHE.hits) + " hits, "
+              + str(gceaccess.DEVICE_CACHE.misses) + " misses")
+    if gceaccess.GEAR_RESOLVER:
+        # --bulk-gear: the requests for the gear of all activities, instead of one per activity
+        print("Gear requests......" + str(gceaccess.GEAR_RESOLVER.requests))
+    if ARGS.rate > 0:
+        print("Request rate......." + "{0:.2f}".format(ARGS.rate) + "/s configured, up to "
+              + "{0:.2f}".format(max(ARGS.max_rate, ARGS.rate)) + "/s")
+    for host, host_rate in sorted(gceaccess.RATE_LIMITER.observed().items()):
+        print("Observed rate......" + "{0:.2f}".format(host_rate) + "/s to " + host)
+    # where the adaptive limit of each host ended, below the configured rate after backing off
+    for host, host_rate in sorted(gceaccess.RATE_LIMITER.current().items()):
+        print("Final rate limit..." + "{0:.2f}".format(host_rate) + "/s to " + host)
+    if TRANSPORT:
+        print("Connections opened." + str(TRANSPORT_STATS["opened"]))
+        print("Requests served...." + str(TRANSPORT_STATS["requests"]))
+
+    # open the csv file in an external program if requested
+    if len(ARGS.external):
+        print("Open CSV output: " + CSV_FILENAME)
+        # open CSV file. Comment this line out if you don't want this behavior
+        call([ARGS.external, "--" + ARGS.args, CSV_FILENAME])
+
+    print("Done!")